@@ -0,0 +1,206 @@
+"""Runs many concurrent `docker-alias run` invocations against a fake engine and checks their shared state.
+
+Usage: python benchmarks/bench_fan_out.py [--runs N] [--registrations N] [--build-delay S] [--keep]
+
+Every run needs the same auto-built image and driver volume, like a `make -j` calling one shim many times.
+Afterwards the image must have been built once, every container name must be unique, the registrations must
+still hold every concurrently registered path and no driver volume may be left behind.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_engine import EngineState, FakeEngine
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOCKER_ALIAS = os.path.join(REPOSITORY_DIR, 'docker-alias.py')
+
+# the docker cli is only used for the container itself, record the name and pretend to do some work
+FAKE_DOCKER_CLI = '''#!/bin/sh
+for argument in "$@"; do
+    case "$argument" in
+        --name=*) echo "${argument#--name=}" >> "$FAKE_DOCKER_LOG" ;;
+    esac
+done
+sleep 0.05
+'''
+
+YAML_CONFIG = '''
+volumes:
+  cache:
+    driver: local
+containers:
+  tool:
+    build:
+      context: .
+    auto_network: false
+    volumes:
+      - cache:/cache
+    commands:
+      - tool
+'''
+
+
+def create_workspace(root: str, registrations: int) -> dict:
+    project_dir = os.path.join(root, 'project')
+    os.makedirs(project_dir)
+    with open(os.path.join(project_dir, 'docker-alias.yml'), 'w') as file:
+        file.write(textwrap.dedent(YAML_CONFIG))
+    with open(os.path.join(project_dir, 'Dockerfile'), 'w') as file:
+        file.write('FROM scratch\n')
+
+    registration_dirs = []
+    for index in range(registrations):
+        registration_dir = os.path.join(root, 'registered', str(index))
+        os.makedirs(registration_dir)
+        with open(os.path.join(registration_dir, 'docker-alias.yml'), 'w') as file:
+            file.write('containers: {}\n')
+        registration_dirs.append(registration_dir)
+
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    docker_cli = os.path.join(bin_dir, 'docker')
+    with open(docker_cli, 'w') as file:
+        file.write(FAKE_DOCKER_CLI)
+    os.chmod(docker_cli, 0o755)
+
+    socket_path = os.path.join(root, 'docker.sock')
+    environment = dict(
+        os.environ,
+        HOME=os.path.join(root, 'home'),
+        PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        DOCKER_HOST='unix://' + socket_path,
+        DOCKER_ALIAS_NO_SERVER='1',
+        DOCKER_ALIAS_NO_PLAN='1',
+        FAKE_DOCKER_LOG=os.path.join(root, 'containers.log'),
+    )
+    return {
+        'project_dir': project_dir,
+        'registration_dirs': registration_dirs,
+        'socket_path': socket_path,
+        'environment': environment,
+    }
+
+
+def invoke(arguments, cwd: str, environment: dict) -> dict:
+    start = time.monotonic()
+    process = subprocess.run(
+        [sys.executable, DOCKER_ALIAS] + arguments,
+        cwd=cwd,
+        env=environment,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True
+    )
+    return {'returncode': process.returncode, 'duration': time.monotonic() - start, 'output': process.stdout}
+
+
+def run_concurrently(jobs, workers: int):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda job: invoke(*job), jobs))
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def read_state(state_dir: str, namespace: str) -> dict:
+    try:
+        with open(os.path.join(state_dir, namespace + '.json')) as file:
+            return json.load(file)
+    except OSError:
+        return {}
+
+
+def check(workspace: dict, state: dict, runs: list, registrations: list) -> list:
+    problems = []
+    failed = [result for result in runs + registrations if result['returncode'] != 0]
+    for result in failed[:3]:
+        problems.append('invocation failed with {code}: {output}'.format(
+            code=result['returncode'],
+            output=result['output'].strip()[-500:]
+        ))
+    if len(failed) > 3:
+        problems.append('{count} more invocations failed'.format(count=len(failed) - 3))
+
+    builds = state['counters'].get('POST /build', 0)
+    if builds != 1:
+        problems.append('image was built {count} times instead of once'.format(count=builds))
+
+    with open(workspace['environment']['FAKE_DOCKER_LOG']) as file:
+        container_names = file.read().split()
+    if len(set(container_names)) != len(container_names) or len(container_names) != len(runs):
+        problems.append('{unique} unique container names for {runs} runs'.format(
+            unique=len(set(container_names)),
+            runs=len(runs)
+        ))
+
+    if state['volumes']:
+        problems.append('volumes left behind: ' + ', '.join(state['volumes']))
+
+    state_dir = os.path.join(workspace['environment']['HOME'], '.config', 'docker-alias', 'state')
+    registered = read_state(state_dir, 'registrations')
+    missing = [
+        path for path in workspace['registration_dirs']
+        if os.path.join(path, 'docker-alias.yml') not in registered
+    ]
+    if missing:
+        problems.append('{count} concurrently added paths are not registered'.format(count=len(missing)))
+    if not read_state(state_dir, 'build_hashes'):
+        problems.append('the build hash was not stored')
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=32)
+    parser.add_argument('--registrations', type=int, default=16)
+    parser.add_argument('--build-delay', type=float, default=1.0)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary workspace')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='docker-alias-fan-out-')
+    workspace = create_workspace(root, args.registrations)
+    engine = FakeEngine(workspace['socket_path'], EngineState(build_delay=args.build_delay)).start()
+    try:
+        start = time.monotonic()
+        jobs = [(['run', 'tool'], workspace['project_dir'], workspace['environment'])] * args.runs
+        jobs = jobs + [(['add'], path, workspace['environment']) for path in workspace['registration_dirs']]
+        results = run_concurrently(jobs, len(jobs))
+        wall_time = time.monotonic() - start
+        runs, registrations = results[:args.runs], results[args.runs:]
+        problems = check(workspace, engine.state.snapshot(), runs, registrations)
+    finally:
+        engine.stop()
+        if args.keep:
+            print('workspace: ' + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    durations = [result['duration'] for result in runs]
+    print('{runs} runs and {registrations} registrations in {wall:.2f}s'.format(
+        runs=args.runs,
+        registrations=args.registrations,
+        wall=wall_time
+    ))
+    print('run latency  p50 {p50:.3f}s  p95 {p95:.3f}s  max {max:.3f}s'.format(
+        p50=percentile(durations, 0.5),
+        p95=percentile(durations, 0.95),
+        max=max(durations)
+    ))
+    for problem in problems:
+        print('FAIL: ' + problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
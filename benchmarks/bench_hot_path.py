@@ -0,0 +1,270 @@
+"""Measures the per-invocation overhead of docker-alias against a fake engine.
+
+Usage: python benchmarks/bench_hot_path.py [--repeat N] [--output FILE] [--baseline FILE] [--threshold F]
+           [--images N] [--containers N] [--volumes N] [--networks N] [--yaml-containers N]
+
+Every benchmark reports the time of one call in microseconds. Results are written as JSON with --output;
+given a previous result file as --baseline, the run fails if a benchmark got slower than the threshold.
+Compare results of the same machine and the same seed parameters only.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from statistics import median
+from typing import Callable, Dict, List, Tuple
+
+from fake_engine import EngineState, FakeEngine
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DOCKER_ALIAS = os.path.join(REPOSITORY_DIR, 'docker-alias.py')
+# a sample is timed over as many calls as fit into this, short benchmarks are otherwise dominated by the clock
+MIN_SAMPLE_TIME = 0.05
+
+FAKE_DOCKER_CLI = '#!/bin/sh\nexit 0\n'
+
+PARENT_YAML_CONTAINER = '''  filler_{index}:
+    image: alpine:3.{index}
+    volumes:
+      - $YAML_LOCATION_DIR:$DEFAULT_WORKING_DIR
+    environment:
+      - HOME_DIR=$HOME
+      - JOB=${{CI_JOB_ID:-local}}
+    commands:
+      - filler-{index}
+'''
+
+PROJECT_YAML = '''volumes:
+  cache:
+    driver: local
+containers:
+  tool:
+    image: node:20
+    volumes:
+      - $YAML_LOCATION_DIR:$DEFAULT_WORKING_DIR
+      - cache:/cache
+    environment:
+      - NODE_ENV=${NODE_ENV:-development}
+      - USER_ID=$UID
+    networks:
+      - default
+    commands:
+      - tool
+      - npm
+      - npx
+    command_pattern_conditional_config:
+      - "npm install":
+          environment:
+            - NPM_CONFIG_CACHE=/cache
+      - "npm run *":
+          environment:
+            - RUNNER=1
+      - "re:npx\\\\s+":
+          user: "$UID"
+'''
+
+
+def create_workspace(root: str, yaml_containers: int) -> str:
+    workspace_dir = os.path.join(root, 'workspace')
+    project_dir = os.path.join(workspace_dir, 'project')
+    os.makedirs(project_dir)
+    with open(os.path.join(workspace_dir, 'docker-alias.yml'), 'w') as file:
+        file.write('containers:\n')
+        for index in range(yaml_containers):
+            file.write(PARENT_YAML_CONTAINER.format(index=index))
+    with open(os.path.join(project_dir, 'docker-alias.yml'), 'w') as file:
+        file.write(PROJECT_YAML)
+
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, 'docker'), 'w') as file:
+        file.write(FAKE_DOCKER_CLI)
+    os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+
+    os.environ.update(
+        HOME=os.path.join(root, 'home'),
+        PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        DOCKER_HOST='unix://' + os.path.join(root, 'docker.sock'),
+        DOCKER_ALIAS_NO_SERVER='1',
+        DOCKER_ALIAS_NO_PLAN='1',
+    )
+    return project_dir
+
+
+def load_cli():
+    spec = importlib.util.spec_from_file_location('docker_alias_cli', DOCKER_ALIAS)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.DockerAliasCLI
+
+
+def create_benchmarks(project_dir: str) -> List[Tuple[str, Callable[[], object]]]:
+    # lib reads HOME when it is imported, so only after the workspace exists
+    from lib.config import YAMLConfigUtil
+    from lib.config_container import ConfigContainerUtil
+    from lib.docker_util import DockerUtil
+
+    yaml_config_util = YAMLConfigUtil()
+    yaml_path = os.path.join(project_dir, 'docker-alias.yml')
+    with open(yaml_path) as file:
+        yaml_string = file.read()
+    config_container_util = ConfigContainerUtil()
+    config_container_util.resolve_config_containers()
+    config_container, command = config_container_util.find_command('npm')
+    docker_alias_cli = load_cli()
+
+    def merge_config_containers():
+        # a fresh util per call, the cached matcher and merge result only help within one invocation
+        return ConfigContainerUtil().merge_config_containers(config_container, 'npm run build')
+
+    def build_command():
+        DockerUtil.reset_after_fork()
+        return DockerUtil(True).build_command(config_container, command, ['run', 'build'])
+
+    def dispatch():
+        DockerUtil.reset_after_fork()
+        sys.argv = ['docker-alias', 'run', 'npm', 'run', 'build']
+        try:
+            docker_alias_cli()
+        except SystemExit as e:
+            if e.code:
+                raise RuntimeError('docker-alias run exited with {code}'.format(code=e.code))
+
+    def process():
+        subprocess.run(
+            [sys.executable, DOCKER_ALIAS, 'run', 'npm', 'run', 'build'],
+            stdin=subprocess.DEVNULL,
+            check=True
+        )
+
+    return [
+        ('find_yaml_configs', yaml_config_util.find_yaml_configs),
+        ('replace_variables', lambda: yaml_config_util.replace_variables(yaml_path, yaml_string)),
+        ('resolve_config_containers', lambda: ConfigContainerUtil().resolve_config_containers()),
+        ('merge_config_containers', merge_config_containers),
+        ('build_command', build_command),
+        ('cli_run_dispatch', dispatch),
+        ('cli_run_process', process),
+    ]
+
+
+def measure(function: Callable[[], object], repeat: int) -> Dict[str, float]:
+    function()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_SAMPLE_TIME:
+            break
+        number = number * 10 if elapsed < MIN_SAMPLE_TIME / 10 else number * 2
+
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        'min_us': min(samples) * 1e6,
+        'median_us': median(samples) * 1e6,
+        'max_us': max(samples) * 1e6,
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    if results['parameters'] != baseline.get('parameters'):
+        print('warning: the baseline was measured with different parameters')
+    regressions = []
+    print('')
+    print('{name:<28}{baseline:>14}{current:>14}{change:>9}'.format(
+        name='benchmark', baseline='baseline us', current='current us', change='change'
+    ))
+    for name, result in results['benchmarks'].items():
+        if name not in baseline.get('benchmarks', {}):
+            continue
+        # the fastest sample is the least disturbed by other load on the machine
+        before = baseline['benchmarks'][name]['min_us']
+        change = result['min_us'] / before - 1
+        print('{name:<28}{baseline:>14.1f}{current:>14.1f}{change:>+8.0%}'.format(
+            name=name, baseline=before, current=result['min_us'], change=change
+        ))
+        if change > threshold:
+            regressions.append('{name} is {change:.0%} slower than the baseline'.format(name=name, change=change))
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--only', action='append', help='run only this benchmark, can be repeated')
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--containers', type=int, default=50)
+    parser.add_argument('--volumes', type=int, default=100)
+    parser.add_argument('--networks', type=int, default=30)
+    parser.add_argument('--yaml-containers', type=int, default=25)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='docker-alias-bench-')
+    working_dir = os.getcwd()
+    project_dir = create_workspace(root, args.yaml_containers)
+    state = EngineState().seed(args.images, args.containers, args.volumes, args.networks)
+    state.add_image('node:20')
+    state.add_network('project_default')
+    engine = FakeEngine(os.path.join(root, 'docker.sock'), state).start()
+    sys.path.insert(0, REPOSITORY_DIR)
+    os.chdir(project_dir)
+    try:
+        results = {
+            'meta': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            },
+            'parameters': {
+                'images': args.images,
+                'containers': args.containers,
+                'volumes': args.volumes,
+                'networks': args.networks,
+                'yaml_containers': args.yaml_containers,
+            },
+            'benchmarks': {},
+        }
+        for name, function in create_benchmarks(project_dir):
+            if args.only and name not in args.only:
+                continue
+            result = results['benchmarks'][name] = measure(function, max(1, args.repeat))
+            print('{name:<28}{min_us:>12.1f} us  (median {median_us:.1f} us, {number} calls x {repeat})'.format(
+                name=name, **result
+            ))
+    finally:
+        os.chdir(working_dir)
+        engine.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print('FAIL: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
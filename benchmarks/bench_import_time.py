@@ -0,0 +1,104 @@
+"""Checks what a warm `docker-alias run` imports, measured with python -X importtime against a fake engine.
+
+Usage: python benchmarks/bench_import_time.py [--repeat N] [--budget-ms MS] [--top N]
+
+Every shim call pays for these imports. The run fails if a module that only other commands or a cold config
+cache need shows up, or with --budget-ms if the imports on top of a bare interpreter take longer than that.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from typing import Dict, List
+
+from bench_hot_path import DOCKER_ALIAS, create_workspace
+from fake_engine import EngineState, FakeEngine
+
+# yaml is only parsed on a config cache miss, the sdk only builds and pulls, argparse only serves the other commands,
+# configparser only migrates an old config.ini, ssl and http.client only talk to an engine over tcp
+FORBIDDEN_MODULES = (
+    'yaml', 'docker', 'requests', 'argparse', 'concurrent.futures', 'tempfile', 'configparser', 'ssl', 'http.client',
+    'lib.shim_binary'
+)
+
+
+def import_times(arguments: List[str], cwd: str) -> Dict[str, int]:
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + arguments,
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if process.returncode != 0:
+        raise RuntimeError('{arguments} exited with {code}:\n{output}'.format(
+            arguments=' '.join(arguments),
+            code=process.returncode,
+            output=process.stderr[-2000:]
+        ))
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_time)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, help='fail if the added imports take longer than this')
+    parser.add_argument('--top', type=int, default=10, help='number of the slowest modules to print')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='docker-alias-import-time-')
+    project_dir = create_workspace(root, yaml_containers=5)
+    state = EngineState()
+    state.add_image('node:20')
+    state.add_network('project_default')
+    engine = FakeEngine(os.path.join(root, 'docker.sock'), state).start()
+    try:
+        run_arguments = [DOCKER_ALIAS, 'run', 'npm', 'run', 'build']
+        # the first run fills the config cache, only the warm path is what every shim call pays
+        import_times(run_arguments, project_dir)
+        baseline = set(import_times(['-c', 'pass'], project_dir))
+        samples = [import_times(run_arguments, project_dir) for _ in range(max(1, args.repeat))]
+    finally:
+        engine.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    added = [{name: time for name, time in sample.items() if name not in baseline} for sample in samples]
+    totals = [sum(sample.values()) / 1000 for sample in added]
+    print('{count} modules on top of a bare interpreter, {total:.1f} ms (median of {repeat})'.format(
+        count=len(added[0]),
+        total=median(totals),
+        repeat=len(totals)
+    ))
+    slowest = sorted(added[0], key=lambda name: median(sample.get(name, 0) for sample in added), reverse=True)
+    for name in slowest[:args.top]:
+        print('{time:>10.1f} ms  {name}'.format(
+            time=median(sample.get(name, 0) for sample in added) / 1000,
+            name=name
+        ))
+
+    problems = [
+        '{name} is imported by run'.format(name=forbidden) for forbidden in FORBIDDEN_MODULES
+        if any(name == forbidden or name.startswith(forbidden + '.') for name in added[0])
+    ]
+    if args.budget_ms is not None and median(totals) > args.budget_ms:
+        problems.append('imports take {total:.1f} ms, the budget is {budget:.1f} ms'.format(
+            total=median(totals),
+            budget=args.budget_ms
+        ))
+    for problem in problems:
+        print('FAIL: ' + problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
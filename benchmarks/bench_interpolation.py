@@ -0,0 +1,60 @@
+"""Compares the YAML variable interpolation with the former str.replace loop.
+
+Usage: python benchmarks/bench_interpolation.py [--env-size N] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.variable_interpolation import VariableInterpolator  # noqa: E402
+
+YAML_BLOCK = '''  tool_{index}:
+    image: node:20
+    volumes:
+      - $YAML_LOCATION_DIR:$DEFAULT_WORKING_DIR
+      - $HOME/.npm:/home/node/.npm
+    environment:
+      - CI_JOB=${{CI_JOB_ID:-local}}
+      - PREFIX=$HOMEBREW_PREFIX
+    user: "$UID"
+'''
+
+
+def legacy_replace_variables(environment: dict, fallbacks: dict, yaml_string: str) -> str:
+    for name, value in environment.items():
+        yaml_string = yaml_string.replace('$' + name, value)
+    for name, value in fallbacks.items():
+        yaml_string = yaml_string.replace('$' + name, value)
+    return yaml_string
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--env-size', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    environment = {'CI_VARIABLE_{index}'.format(index=index): 'value-{index}'.format(index=index)
+                   for index in range(args.env_size)}
+    environment.update({'HOME': '/home/ci', 'HOMEBREW_PREFIX': '/home/linuxbrew'})
+    fallbacks = {'YAML_LOCATION_DIR': '/project', 'UID': '1000', 'DEFAULT_WORKING_DIR': '/app'}
+
+    print('{:>10} {:>12} {:>12} {:>14}'.format('size', 'legacy ms', 'tokenizer ms', 'tokenizer us/KB'))
+    for blocks in (10, 100, 1000, 10000):
+        yaml_string = 'containers:\n' + ''.join(YAML_BLOCK.format(index=index) for index in range(blocks))
+        legacy = min(timeit.repeat(
+            lambda: legacy_replace_variables(environment, fallbacks, yaml_string), number=1, repeat=args.repeat
+        ))
+        tokenizer = min(timeit.repeat(
+            lambda: VariableInterpolator(environment, fallbacks).interpolate(yaml_string), number=1, repeat=args.repeat
+        ))
+        print('{:>10} {:>12.2f} {:>12.2f} {:>14.2f}'.format(
+            len(yaml_string), legacy * 1000, tokenizer * 1000, tokenizer * 10 ** 6 / (len(yaml_string) / 1024)
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+"""A stand-in Docker engine on a unix socket, just enough of the API for docker-alias.
+
+Usage: python benchmarks/fake_engine.py SOCKET_PATH [--build-delay S] [--pull-delay S]
+           [--images N] [--containers N] [--volumes N] [--networks N]
+"""
+import argparse
+import json
+import os
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+VERSION_PREFIX = re.compile(r'^/v([0-9.]+)')
+# like a 29.0 engine, requests pinned to a version outside this range are rejected
+API_VERSION = '1.47'
+MIN_API_VERSION = '1.44'
+
+
+def parse_version(version: str) -> tuple:
+    return tuple(int(part) for part in version.split('.') if part)
+
+
+def normalize(reference: str) -> str:
+    # node, node:latest and docker.io/library/node:latest all name the same image
+    for prefix in ('docker.io/', 'library/'):
+        if reference.startswith(prefix):
+            reference = reference[len(prefix):]
+    if '@' not in reference and ':' not in reference.rsplit('/', 1)[-1]:
+        return reference + ':latest'
+    return reference
+
+
+class EngineState:
+    def __init__(self, build_delay: float = 0.0, pull_delay: float = 0.0) -> None:
+        self.lock = threading.Lock()
+        self.build_delay = build_delay
+        self.pull_delay = pull_delay
+        self.images: Dict[str, dict] = {}
+        self.containers: Dict[str, dict] = {}
+        self.volumes: Dict[str, dict] = {}
+        self.networks: Dict[str, dict] = {}
+        self.counters: Dict[str, int] = {}
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def add_image(self, reference: str) -> None:
+        with self.lock:
+            self.images[normalize(reference)] = {
+                'Id': 'sha256:' + format(len(self.images), '064x'),
+                'RepoTags': [normalize(reference)],
+                'Config': {'Entrypoint': None},
+            }
+
+    def add_container(self, name: str, labels: Optional[dict] = None) -> None:
+        with self.lock:
+            self.containers[name] = {
+                'Id': format(len(self.containers), '064x'),
+                'Names': ['/' + name],
+                'Labels': labels or {},
+                'Created': int(time.time()),
+                'State': {'Running': True},
+                'Config': {'Labels': labels or {}},
+            }
+
+    def add_volume(self, name: str, driver: str = 'local') -> None:
+        with self.lock:
+            self.volumes[name] = {'Name': name, 'Driver': driver, 'Options': {}}
+
+    def add_network(self, name: str) -> None:
+        with self.lock:
+            self.networks[name] = {'Name': name, 'Id': format(len(self.networks), '064x')}
+
+    def seed(self, images: int = 0, containers: int = 0, volumes: int = 0, networks: int = 0) -> 'EngineState':
+        # unrelated objects, as found on a machine that has been used for a while
+        for index in range(images):
+            self.add_image('seed/image-{index}:latest'.format(index=index))
+        for index in range(containers):
+            self.add_container('seed_container_{index}'.format(index=index))
+        for index in range(volumes):
+            self.add_volume('seed_volume_{index}'.format(index=index))
+        for index in range(networks):
+            self.add_network('seed_{index}_default'.format(index=index))
+        return self
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'images': sorted(self.images),
+                'containers': sorted(self.containers),
+                'volumes': sorted(self.volumes),
+                'networks': sorted(self.networks),
+            }
+
+
+GET_ROUTES = (
+    (re.compile(r'^/_ping$'), 'get_ping'),
+    (re.compile(r'^/version$'), 'get_version'),
+    (re.compile(r'^/_state$'), 'get_state'),
+    (re.compile(r'^/images/json$'), 'list_images'),
+    (re.compile(r'^/images/(.+)/json$'), 'inspect_image'),
+    (re.compile(r'^/containers/json$'), 'list_containers'),
+    (re.compile(r'^/containers/(.+)/json$'), 'inspect_container'),
+    (re.compile(r'^/volumes$'), 'list_volumes'),
+    (re.compile(r'^/volumes/(.+)$'), 'inspect_volume'),
+    (re.compile(r'^/networks$'), 'list_networks'),
+)
+POST_ROUTES = (
+    (re.compile(r'^/build$'), 'build_image'),
+    (re.compile(r'^/images/create$'), 'pull_image'),
+    (re.compile(r'^/volumes/create$'), 'create_volume'),
+)
+
+
+class EngineHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: EngineState = None
+    body = b''
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def address_string(self) -> str:
+        return 'unix'
+
+    def read_body(self) -> bytes:
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send_json(self, status: int, value) -> None:
+        data = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, chunks) -> None:
+        # like the real engine one json object per http chunk, the docker sdk decodes them one by one
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in chunks:
+            data = json.dumps(chunk).encode('utf-8') + b'\r\n'
+            self.wfile.write(format(len(data), 'x').encode('ascii') + b'\r\n' + data + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_object(self, value: Optional[dict]) -> None:
+        if value is None:
+            self.send_json(404, {'message': 'No such object'})
+        else:
+            self.send_json(200, value)
+
+    def route(self):
+        url = urlsplit(self.path)
+        return VERSION_PREFIX.sub('', url.path), {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+    def do_HEAD(self) -> None:
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def get_version_error(self) -> Optional[str]:
+        match = VERSION_PREFIX.match(urlsplit(self.path).path)
+        if not match:
+            return None
+        version = parse_version(match.group(1))
+        if version > parse_version(API_VERSION):
+            return 'client version {version} is too new. Maximum supported API version is {maximum}'.format(
+                version=match.group(1),
+                maximum=API_VERSION
+            )
+        if version < parse_version(MIN_API_VERSION):
+            return 'client version {version} is too old. Minimum supported API version is {minimum}'.format(
+                version=match.group(1),
+                minimum=MIN_API_VERSION
+            )
+        return None
+
+    def dispatch(self, routes) -> None:
+        error = self.get_version_error()
+        if error:
+            self.send_json(400, {'message': error})
+            return
+        path, query = self.route()
+        for pattern, handler_name in routes:
+            match = pattern.match(path)
+            if match:
+                getattr(self, handler_name)(query, *[unquote(group) for group in match.groups()])
+                return
+        self.send_object(None)
+
+    def do_GET(self) -> None:
+        self.state.count('GET ' + re.sub(r'^/(\w+)/.+', r'/\1/*', self.route()[0]))
+        self.dispatch(GET_ROUTES)
+
+    def do_POST(self) -> None:
+        self.body = self.read_body()
+        self.state.count('POST ' + self.route()[0])
+        self.dispatch(POST_ROUTES)
+
+    def get_ping(self, query: dict) -> None:
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def get_version(self, query: dict) -> None:
+        self.send_json(200, {'ApiVersion': API_VERSION, 'MinAPIVersion': MIN_API_VERSION, 'Version': '29.0.0'})
+
+    def get_state(self, query: dict) -> None:
+        self.send_json(200, self.state.snapshot())
+
+    def list_images(self, query: dict) -> None:
+        with self.state.lock:
+            self.send_json(200, list(self.state.images.values()))
+
+    def inspect_image(self, query: dict, name: str) -> None:
+        self.send_object(self.state.images.get(normalize(name)))
+
+    def list_containers(self, query: dict) -> None:
+        label = json.loads(query.get('filters', '{}')).get('label')
+        with self.state.lock:
+            self.send_json(200, [
+                container for container in self.state.containers.values()
+                if not label or all(name.split('=')[0] in container['Labels'] for name in label)
+            ])
+
+    def inspect_container(self, query: dict, name: str) -> None:
+        self.send_object(self.state.containers.get(name))
+
+    def list_volumes(self, query: dict) -> None:
+        with self.state.lock:
+            self.send_json(200, {'Volumes': list(self.state.volumes.values()), 'Warnings': None})
+
+    def inspect_volume(self, query: dict, name: str) -> None:
+        self.send_object(self.state.volumes.get(name))
+
+    def list_networks(self, query: dict) -> None:
+        # like the engine the name filter matches substrings
+        names = json.loads(query.get('filters', '{}')).get('name') or ['']
+        with self.state.lock:
+            self.send_json(200, [
+                network for network in self.state.networks.values()
+                if any(name in network['Name'] for name in names)
+            ])
+
+    def build_image(self, query: dict) -> None:
+        time.sleep(self.state.build_delay)
+        self.state.add_image(query.get('t', 'unnamed'))
+        self.send_stream([{'stream': 'Step 1/1 : FROM scratch\n'}, {'stream': 'Successfully built\n'}])
+
+    def pull_image(self, query: dict) -> None:
+        time.sleep(self.state.pull_delay)
+        reference = query.get('fromImage', '')
+        if query.get('tag'):
+            reference += ':' + query['tag']
+        self.state.add_image(reference)
+        self.send_stream([{'status': 'Pulling from ' + reference}, {'status': 'Download complete'}])
+
+    def create_volume(self, query: dict) -> None:
+        name = json.loads(self.body or b'{}').get('Name')
+        with self.state.lock:
+            created = name not in self.state.volumes
+        if created:
+            self.state.add_volume(name)
+        with self.state.lock:
+            self.send_json(201, self.state.volumes[name])
+
+    def do_DELETE(self) -> None:
+        path, _ = self.route()
+        state = self.state
+        state.count('DELETE ' + re.sub(r'^/(\w+)/.+', r'/\1/*', path))
+        collection = {'/containers/': state.containers, '/volumes/': state.volumes}
+        for prefix, objects in collection.items():
+            if path.startswith(prefix):
+                with state.lock:
+                    removed = objects.pop(unquote(path[len(prefix):]), None)
+                if removed is None:
+                    self.send_object(None)
+                else:
+                    self.send_response(204)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                return
+        self.send_object(None)
+
+
+class FakeEngine(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # docker-alias opens a connection per process, a burst of them overflows the default backlog of 5
+    request_queue_size = 256
+
+    def __init__(self, socket_path: str, state: EngineState) -> None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        handler = type('BoundEngineHandler', (EngineHandler,), {'state': state})
+        super().__init__(socket_path, handler)
+        self.socket_path = socket_path
+        self.state = state
+
+    def start(self) -> 'FakeEngine':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('socket_path')
+    parser.add_argument('--build-delay', type=float, default=0.0)
+    parser.add_argument('--pull-delay', type=float, default=0.0)
+    parser.add_argument('--images', type=int, default=0)
+    parser.add_argument('--containers', type=int, default=0)
+    parser.add_argument('--volumes', type=int, default=0)
+    parser.add_argument('--networks', type=int, default=0)
+    args = parser.parse_args()
+    state = EngineState(args.build_delay, args.pull_delay)
+    state.seed(args.images, args.containers, args.volumes, args.networks)
+    FakeEngine(args.socket_path, state).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
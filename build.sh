@@ -14,18 +14,31 @@ function cleanup() {
     mkdir "./.pydeps"
 }
 
+# --onedir keeps the unpacked binaries next to a symlink instead of a onefile archive that every shim call
+# extracts to a temporary directory again
 function build_linux() {
     cleanup
     pip3 install --target ".pydeps" --upgrade -r requirements.txt
-    pyinstaller -y --clean --noupx -F docker-alias.py
-    pyinstaller -y --clean --noupx -F docker-alias-daemon.py
+    if [ "$1" == "--onedir" ]; then
+        pyinstaller -y --clean --noupx -D docker-alias.py
+        pyinstaller -y --clean --noupx -D docker-alias-daemon.py
 
-    mkdir "$ZIP_DIR"
-    cp -R dist/docker-alias "$ZIP_DIR"
-    cp -R dist/docker-alias-daemon "$ZIP_DIR"
+        mkdir "$ZIP_DIR"
+        cp -R dist/docker-alias "$ZIP_DIR/docker-alias.dist"
+        cp -R dist/docker-alias-daemon "$ZIP_DIR/docker-alias-daemon.dist"
+        ln -s docker-alias.dist/docker-alias "$ZIP_DIR/docker-alias"
+        ln -s docker-alias-daemon.dist/docker-alias-daemon "$ZIP_DIR/docker-alias-daemon"
+    else
+        pyinstaller -y --clean --noupx -F docker-alias.py
+        pyinstaller -y --clean --noupx -F docker-alias-daemon.py
+
+        mkdir "$ZIP_DIR"
+        cp -R dist/docker-alias "$ZIP_DIR"
+        cp -R dist/docker-alias-daemon "$ZIP_DIR"
+    fi
     cp -R switch_user "$ZIP_DIR"
     cp linux/setup.sh "$ZIP_DIR"
-    zip -r "$ZIP_LINUX64" "$ZIP_DIR"
+    zip -r -y "$ZIP_LINUX64" "$ZIP_DIR"
 }
 
 function build_windows() {
@@ -39,13 +52,13 @@ function build_windows() {
 
 if [ "$1" == "all" ]; then
     if [ -f "./$ZIP_LINUX64" ]; then rm "./$ZIP_LINUX64"; fi
-    build_linux
+    build_linux "$2"
     build_windows
 fi
 
 if [ "$1" == "linux" ]; then
     if [ -f "./$ZIP_LINUX64" ]; then rm "./$ZIP_LINUX64"; fi
-    build_linux
+    build_linux "$2"
 fi
 
 if [ "$1" == "windows" ]; then
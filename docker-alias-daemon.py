@@ -1,46 +1,144 @@
 import os.path
 import sys
+import threading
 import time
 import traceback
+from typing import List
 
 import click
 import daemoniker
 from psutil import pid_exists
 
 from lib.config import INIConfig
+from lib.file_watcher import create_file_watcher
+from lib.run_server import RunServer
 from lib.shim_binary import ShimBinaryManager, collect_defined_shim_binaries
 
 DEFAULT_PID_FILE = os.path.join(INIConfig().get_config_dir(), "docker-alias.pid")
+MAX_ERROR_BACKOFF = 60
+REAP_INTERVAL = 60
 
 
 def get_pid_file() -> str:
     return os.environ.get("DOCKER_ALIAS_PID_FILE", DEFAULT_PID_FILE)
 
 
+def run_command(argv: List[str]) -> int:
+    from lib.command_runner import CommandRunner
+    from lib.tracing import configure_tracing, finish_tracing, span
+
+    # the environment of the calling shim decides, the worker exits without running atexit handlers
+    configure_tracing()
+    try:
+        with span('run_server.worker'):
+            return CommandRunner().run(argv)
+    finally:
+        finish_tracing()
+
+
 class Daemon:
-    def __init__(self) -> None:
+    def __init__(self, serve: bool = False, prefetch: bool = False) -> None:
         self._shim_binary_manager = ShimBinaryManager()
+        self._serve = serve
+        self._prefetch = prefetch
+        self._prefetch_lock = threading.Lock()
+        self._prefetch_running = False
+        self._prefetch_pending = False
 
     def run(self) -> None:
+        if self._serve:
+            # before any thread is started, see start_run_server
+            self.start_run_server()
+        file_watcher = create_file_watcher()
+        error_backoff = 0
+        changed = True
         while True:
             try:
-                ini_config = INIConfig()
+                if changed:
+                    self.sync(file_watcher)
+                error_backoff = 0
+                self.reap()
+                changed = file_watcher.wait(REAP_INTERVAL)
+            except Exception:
+                traceback.print_exc()
+                error_backoff = min(max(error_backoff * 2, 1), MAX_ERROR_BACKOFF)
+                time.sleep(error_backoff)
+
+    @staticmethod
+    def start_run_server() -> None:
+        # imported up front so forked run requests start with a warm interpreter
+        import lib.command_runner  # noqa: F401
+
+        # the run server forks a worker per request, so it gets a process of its own that is forked before the
+        # daemon starts any thread. It stops once the write end of the pipe is closed, when the daemon exits.
+        parent_read, parent_write = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            os.close(parent_write)
+            try:
+                RunServer(run_command).serve_forever(parent_read)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(0)
+        os.close(parent_read)
+
+    @staticmethod
+    def reap() -> None:
+        from lib.docker_util import DockerUtil
+        from lib.persistent_container import PersistentContainerManager
+        from lib.volume_manager import VolumeManager
 
-                if not ini_config.is_enabled():
-                    self._shim_binary_manager.remove_all()
-                    time.sleep(10)
-                    continue
+        try:
+            PersistentContainerManager(DockerUtil(True)).reap(DockerUtil.get_engine())
+            VolumeManager(DockerUtil(True)).reap(DockerUtil.get_engine())
+        except Exception:
+            # the docker engine may simply not be running right now
+            pass
 
-                defined_shim_binaries = collect_defined_shim_binaries(ini_config)
-                self._shim_binary_manager.sync(defined_shim_binaries)
+    def sync(self, file_watcher) -> None:
+        ini_config = INIConfig()
+        # watch before syncing so changes made while syncing trigger another pass
+        file_watcher.watch(ini_config.get_watched_paths() + ini_config.get_yaml_paths())
+
+        if not ini_config.is_enabled():
+            self._shim_binary_manager.remove_all()
+            return
+
+        # the run server and prefetch threads make forking parser processes unsafe here
+        defined_shim_binaries = collect_defined_shim_binaries(ini_config, parallel=False)
+        self._shim_binary_manager.sync(defined_shim_binaries)
+        if self._prefetch:
+            self.start_prefetch()
+
+    def start_prefetch(self) -> None:
+        with self._prefetch_lock:
+            if self._prefetch_running:
+                # pull again once the running prefetch is done, the changed config may need other images
+                self._prefetch_pending = True
+                return
+            self._prefetch_running = True
+        threading.Thread(target=self.prefetch, daemon=True).start()
+
+    def prefetch(self) -> None:
+        from lib.image_prefetcher import ImagePrefetcher, collect_external_images, collect_registered_config_containers
 
-                if not ini_config.is_enabled():
-                    # Handle case where configuration toggled while syncing
-                    self._shim_binary_manager.remove_all()
-                    continue
-                time.sleep(10)
+        while True:
+            try:
+                ImagePrefetcher(True).run(
+                    collect_external_images(collect_registered_config_containers()),
+                    missing_only=True
+                )
             except Exception:
                 traceback.print_exc()
+            with self._prefetch_lock:
+                if not self._prefetch_pending:
+                    self._prefetch_running = False
+                    return
+                self._prefetch_pending = False
 
 
 @click.group()
@@ -50,17 +148,21 @@ def cli() -> None:
 
 @cli.command("start")
 @click.option("--no-daemon", is_flag=True, flag_value=True, default=False)
-def start(no_daemon: bool) -> None:
+@click.option("--serve", is_flag=True, flag_value=True, default=False,
+              help="Also serve 'docker-alias run' requests over a unix socket")
+@click.option("--prefetch", is_flag=True, flag_value=True, default=False,
+              help="Pull missing images in the background whenever a registered config changes")
+def start(no_daemon: bool, serve: bool, prefetch: bool) -> None:
     if no_daemon:
         try:
-            Daemon().run()
+            Daemon(serve, prefetch).run()
         except KeyboardInterrupt:
             pass
     else:
         with daemoniker.Daemonizer() as (_, daemonizer):
             try:
                 is_parent, *_ = daemonizer(get_pid_file())
-                Daemon().run()
+                Daemon(serve, prefetch).run()
             except SystemExit as e:
                 if str(e) == 'Unable to acquire PID file.':
                     with open(get_pid_file()) as f:
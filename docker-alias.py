@@ -1,26 +1,27 @@
-import argparse
 import os.path
 import sys
-import termios
 
-from lib.config import INIConfig, YAML_CONFIG_FILE_NAME, INI_CONFIG_FILE_PATH, VERSION
-from lib.config_container import ConfigContainerUtil
-from lib.shim_binary import ShimBinaryManager, collect_defined_shim_binaries
+from lib.config import YAML_CONFIG_FILE_NAME, STATE_DIR, VERSION
+from lib.tracing import TRACE_ENVIRONMENT_VARIABLE, configure_tracing, span
+
+# every shim call starts here, so commands import what they need themselves and run skips argparse
+COMMANDS = ('add', 'build', 'disable', 'enable', 'list', 'pull', 'remove', 'run')
 
 
 class DockerAliasCLI(object):
-    ini_config = INIConfig()
-    add_description = 'Adds a new {yaml_config_file} to {ini_config_file}'.format(
+    _ini_config = None
+    add_description = 'Adds a new {yaml_config_file} to {state_dir}'.format(
         yaml_config_file=YAML_CONFIG_FILE_NAME,
-        ini_config_file=INI_CONFIG_FILE_PATH
+        state_dir=STATE_DIR
     )
-    remove_description = 'Removes a {yaml_config_file} from {ini_config_file}'.format(
+    remove_description = 'Removes a {yaml_config_file} from {state_dir}'.format(
         yaml_config_file=YAML_CONFIG_FILE_NAME,
-        ini_config_file=INI_CONFIG_FILE_PATH
+        state_dir=STATE_DIR
     )
     list_description = 'List all containers and their commands'
     run_description = 'Runs an command in an container'
     build_description = 'Builds container-images'
+    pull_description = 'Pulls the external images of all registered configs'
     disable_description = 'Disables docker-alias'
     enable_description = 'Enables docker-alias'
     usage = '''
@@ -28,10 +29,11 @@ docker-alias <command> [<args>] [--verbose]
 
 Available Commands:
    add      {add_description}
-   build    {build_description} [ all || <container_name> ]
+   build    {build_description} [ all || <container_name> ] [--jobs N] [--no-cache]
    disable  {disable_description}
    enable   {enable_description}
    list     {list_description}
+   pull     {pull_description} [ all || <container_name> ] [--jobs N]
    remove   {remove_description}
    run      {run_description} [ <container_name> || <command_name> ]
 
@@ -41,6 +43,12 @@ Version: {version}
     quiet = False
 
     def __init__(self):
+        if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+            getattr(self, sys.argv[1])()
+            return
+
+        import argparse
+
         parser = argparse.ArgumentParser(
             description='docker-alias cli',
             usage=self.usage.format(
@@ -49,6 +57,7 @@ Version: {version}
                 disable_description=self.disable_description,
                 enable_description=self.enable_description,
                 list_description=self.list_description,
+                pull_description=self.pull_description,
                 remove_description=self.remove_description,
                 run_description=self.run_description,
                 version=VERSION
@@ -69,7 +78,17 @@ Version: {version}
             sys.exit(1)
         getattr(self, args.command)()
 
+    @property
+    def ini_config(self):
+        if DockerAliasCLI._ini_config is None:
+            from lib.config import INIConfig
+
+            DockerAliasCLI._ini_config = INIConfig()
+        return DockerAliasCLI._ini_config
+
     def add(self):
+        import argparse
+
         parser = argparse.ArgumentParser(
             description=self.add_description
         )
@@ -89,9 +108,11 @@ Version: {version}
 
         self.ini_config.add_yaml_path(path)
         self.sync_shim_binaries()
-        print('Added ' + path + ' to config.ini')
+        print('Added ' + path + ' to the registered configs')
 
     def remove(self):
+        import argparse
+
         parser = argparse.ArgumentParser(
             description=self.remove_description
         )
@@ -111,13 +132,18 @@ Version: {version}
 
         self.ini_config.remove_yaml_path(path)
         self.sync_shim_binaries()
-        print('Removed ' + path + ' from config.ini')
+        print('Removed ' + path + ' from the registered configs')
 
     def sync_shim_binaries(self):
+        from lib.shim_binary import ShimBinaryManager, collect_defined_shim_binaries
+
         defined_shim_binaries = collect_defined_shim_binaries(self.ini_config)
         ShimBinaryManager().sync(defined_shim_binaries)
 
     def list(self):
+        import argparse
+
+        from lib.config_container import ConfigContainerUtil
         from lib.docker_util import DockerUtil
 
         config_container_util = ConfigContainerUtil()
@@ -145,67 +171,107 @@ Version: {version}
             print(key + ": " + cmd + "\n")
 
     def run(self):
-        from lib.docker_util import DockerUtil
+        with span('cli.import'):
+            from lib.command_runner import CommandRunner
 
-        config_container_util = ConfigContainerUtil()
-        parser = argparse.ArgumentParser(description=self.run_description, add_help=False)
-        args, unknown = parser.parse_known_args(sys.argv[2:])
-        if len(unknown) > 0:
-            wanted_container = unknown[0]
-            if '/' in wanted_container:
-                wanted_container = wanted_container.split('/')[-1]
-            unknown.pop(0)
-            attributes = unknown
-            for config_container in config_container_util.resolve_config_containers():
-                config_container = config_container_util.merge_config_containers(
-                    config_container,
-                    ' '.join([wanted_container] + attributes)
-                )
-
-                if config_container.commands:
-                    for command in config_container.commands:
-                        if command.name == wanted_container:
-                            sys.exit(DockerUtil(self.quiet).exec_docker(
-                                config_container, command=command, attributes=attributes)
-                            )
-                if config_container.name == wanted_container:
-                    sys.exit(DockerUtil(self.quiet).exec_docker(config_container, attributes=attributes))
-            if not self.quiet:
-                print('Container ' + wanted_container + ' not found!')
-            sys.exit(1)
+        sys.exit(CommandRunner(self.quiet).run(sys.argv[2:]))
 
     def build(self):
-        from lib.docker_util import DockerUtil
+        import argparse
+
+        from lib.build_scheduler import BuildScheduler, DEFAULT_BUILD_JOBS
+        from lib.config_container import ConfigContainerUtil
 
         config_container_util = ConfigContainerUtil()
         parser = argparse.ArgumentParser(description=self.build_description)
         parser.add_argument('container')
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=DEFAULT_BUILD_JOBS,
+            help='number of images built in parallel (default: {jobs})'.format(jobs=DEFAULT_BUILD_JOBS)
+        )
+        parser.add_argument(
+            '--no-cache',
+            default=False,
+            action='store_true',
+            help='do not use the docker layer cache'
+        )
         args = parser.parse_args(sys.argv[2:])
-        if args.container == 'all':
-            for config_container in config_container_util.resolve_config_containers():
-                if config_container.build:
-                    DockerUtil(self.quiet).build_image(config_container)
+        config_containers = [
+            config_container for config_container in config_container_util.resolve_config_containers()
+            if config_container.build and args.container in ('all', config_container.name)
+        ]
+        if not BuildScheduler(self.quiet, args.jobs, args.no_cache).run(config_containers):
+            sys.exit(1)
+
+    def pull(self):
+        import argparse
 
-        else:
-            for config_container in config_container_util.resolve_config_containers():
-                if config_container.build and config_container.name == args.container:
-                    DockerUtil(self.quiet).build_image(config_container)
+        from lib.image_prefetcher import (
+            DEFAULT_PULL_JOBS, ImagePrefetcher, collect_external_images, collect_registered_config_containers
+        )
+
+        parser = argparse.ArgumentParser(description=self.pull_description)
+        parser.add_argument('container', nargs='?', default='all')
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=DEFAULT_PULL_JOBS,
+            help='number of images pulled in parallel (default: {jobs})'.format(jobs=DEFAULT_PULL_JOBS)
+        )
+        args = parser.parse_args(sys.argv[2:])
+        config_containers = [
+            config_container for config_container in collect_registered_config_containers(self.ini_config)
+            if args.container in ('all', config_container.name)
+        ]
+        if not config_containers:
+            print('Container ' + args.container + ' not found!')
+            sys.exit(1)
+        if not ImagePrefetcher(self.quiet, args.jobs).run(collect_external_images(config_containers)):
+            sys.exit(1)
 
     def disable(self):
+        import argparse
+
+        from lib.shim_binary import ShimBinaryManager
+
         argparse.ArgumentParser(description=self.disable_description).parse_args(sys.argv[2:])
         self.ini_config.set_enabled(False)
         ShimBinaryManager().remove_all()
         print('docker-alias has been disabled')
 
     def enable(self):
+        import argparse
+
         argparse.ArgumentParser(description=self.enable_description).parse_args(sys.argv[2:])
         self.ini_config.set_enabled(True)
         self.sync_shim_binaries()
         print('docker-alias has been enabled')
 
 
+def pop_trace_option() -> None:
+    # --trace, --trace=summary or --trace=FILE before the command, passed on like DOCKER_ALIAS_TRACE
+    while len(sys.argv) > 1 and (sys.argv[1] == '--trace' or sys.argv[1].startswith('--trace=')):
+        option = sys.argv.pop(1)
+        os.environ[TRACE_ENVIRONMENT_VARIABLE] = option.partition('=')[2] or 'stderr'
+
+
 if __name__ == '__main__':
+    pop_trace_option()
+    configure_tracing()
     try:
-        DockerAliasCLI()
+        with span('cli', command=sys.argv[1] if len(sys.argv) > 1 else None):
+            if sys.argv[1:2] == ['run']:
+                from lib.run_server import RunClient
+
+                with span('run_server.request') as request_span:
+                    exit_code = RunClient().run(sys.argv[2:])
+                    request_span.set(handled=exit_code is not None)
+                if exit_code is not None:
+                    sys.exit(exit_code)
+            DockerAliasCLI()
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import pickle
+import re
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Pattern, Tuple
+
+from lib.config_cache import CONFIG_CACHE_DIR
+from lib.file_util import atomic_write
+
+DOCKERIGNORE_FILE_NAME = '.dockerignore'
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = min(8, (os.cpu_count() or 1) + 2)
+# a file written within the timestamp granularity of the last hash could change without changing its stat
+MIN_FILE_AGE_NS = 2 * 10 ** 9
+
+FileStat = Tuple[int, int, int, int]
+
+
+def translate_dockerignore_pattern(pattern: str) -> Pattern:
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                regex += '[' + pattern[i + 1:end].replace('\\', '\\\\').replace('!', '^', 1) + ']'
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile(regex + '$')
+
+
+class DockerIgnore:
+    def __init__(self, lines: List[str]) -> None:
+        self._patterns = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:].strip()
+            line = os.path.normpath(line).lstrip('/')
+            if line in ('', '.'):
+                continue
+            self._patterns.append((translate_dockerignore_pattern(line), negated))
+        self.has_negations = any(negated for _, negated in self._patterns)
+
+    @classmethod
+    def from_context(cls, context: str) -> 'DockerIgnore':
+        try:
+            with open(os.path.join(context, DOCKERIGNORE_FILE_NAME)) as file:
+                return cls(file.read().splitlines())
+        except OSError:
+            return cls([])
+
+    def is_excluded(self, relative_path: str) -> bool:
+        # like docker, a pattern matching a parent directory matches everything below it
+        parts = relative_path.split('/')
+        candidates = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+        excluded = False
+        for pattern, negated in self._patterns:
+            if any(pattern.match(candidate) for candidate in candidates):
+                excluded = not negated
+        return excluded
+
+
+class BuildContextFingerprint:
+    def __init__(self, cache_dir: str = CONFIG_CACHE_DIR) -> None:
+        self._cache_dir = cache_dir
+
+    def get_index_path(self, context: str) -> str:
+        context_hash = hashlib.sha1(context.encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, 'build-context-' + context_hash + '.pickle')
+
+    def load_index(self, context: str) -> Dict[str, Tuple[FileStat, str]]:
+        try:
+            with open(self.get_index_path(context), 'rb') as file:
+                index = pickle.load(file)
+        except Exception:
+            return {}
+        return index if isinstance(index, dict) else {}
+
+    def store_index(self, context: str, index: Dict[str, Tuple[FileStat, str]]) -> None:
+        try:
+            atomic_write(self.get_index_path(context), pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError:
+            pass
+
+    @staticmethod
+    def get_file_stat(stat_result: os.stat_result) -> FileStat:
+        return stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino, stat_result.st_mode & 0o111
+
+    def collect_files(self, context: str, dockerfile: str) -> Dict[str, str]:
+        docker_ignore = DockerIgnore.from_context(context)
+        files = {}
+        directories = ['']
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(os.path.join(context, directory)))
+            except OSError:
+                continue
+            for entry in entries:
+                relative_path = directory + entry.name
+                excluded = docker_ignore.is_excluded(relative_path)
+                if entry.is_dir(follow_symlinks=False):
+                    # an exception pattern may re-include files below an excluded directory
+                    if not excluded or docker_ignore.has_negations:
+                        directories.append(relative_path + '/')
+                elif not excluded:
+                    files[relative_path] = entry.path
+
+        # docker always sends the Dockerfile and the .dockerignore, even if they are ignored
+        for path in (dockerfile, os.path.join(context, DOCKERIGNORE_FILE_NAME)):
+            if os.path.lexists(path):
+                relative_path = os.path.relpath(path, context)
+                files[relative_path if not relative_path.startswith('..') else path] = path
+        return files
+
+    @staticmethod
+    def hash_file(path: str, stat_result: os.stat_result) -> str:
+        if stat.S_ISLNK(stat_result.st_mode):
+            return 'link:' + os.readlink(path)
+        if not stat.S_ISREG(stat_result.st_mode):
+            return ''
+        digest = hashlib.blake2b(digest_size=20)
+        try:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        except OSError as e:
+            return 'error:' + e.__class__.__name__
+        return digest.hexdigest()
+
+    def get_fingerprint(self, context: str, dockerfile: str) -> str:
+        context = os.path.abspath(context)
+        index = self.load_index(context)
+        new_index = {}
+        digests = {}
+        to_hash = []
+        for relative_path, path in self.collect_files(context, dockerfile).items():
+            try:
+                stat_result = os.lstat(path)
+            except OSError:
+                continue
+            file_stat = self.get_file_stat(stat_result)
+            cached = index.get(relative_path)
+            if cached and cached[0] == file_stat:
+                digests[relative_path] = (cached[1], file_stat[3])
+                new_index[relative_path] = cached
+            else:
+                to_hash.append((relative_path, path, stat_result, file_stat))
+
+        if to_hash:
+            with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+                hashed = executor.map(lambda item: self.hash_file(item[1], item[2]), to_hash)
+                newest_allowed = time.time_ns() - MIN_FILE_AGE_NS
+                for (relative_path, _, stat_result, file_stat), digest in zip(to_hash, hashed):
+                    digests[relative_path] = (digest, file_stat[3])
+                    if stat_result.st_mtime_ns < newest_allowed:
+                        new_index[relative_path] = (file_stat, digest)
+
+        if new_index != index:
+            self.store_index(context, new_index)
+
+        fingerprint = hashlib.blake2b(digest_size=20)
+        for relative_path in sorted(digests):
+            digest, mode = digests[relative_path]
+            fingerprint.update(('%s\0%s\0%o\n' % (relative_path, digest, mode)).encode('utf-8'))
+        return fingerprint.hexdigest()
@@ -0,0 +1,196 @@
+import os
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Dict, List, Set
+
+from lib.config_container import ConfigContainer
+from lib.docker_engine import normalize_image_reference
+from lib.docker_util import DockerUtil
+
+DEFAULT_BUILD_JOBS = min(4, os.cpu_count() or 1)
+
+
+def parse_base_images(dockerfile_path: str) -> List[str]:
+    try:
+        with open(dockerfile_path) as file:
+            content = file.read()
+    except OSError:
+        return []
+
+    base_images = []
+    stage_names = set()
+    for line in content.replace('\\\n', ' ').splitlines():
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError:
+            continue
+        if len(words) < 2 or words[0].upper() != 'FROM':
+            continue
+        words = [word for word in words[1:] if not word.startswith('--')]
+        if not words:
+            continue
+        if words[0].lower() not in stage_names and '$' not in words[0] and words[0] != 'scratch':
+            base_images.append(words[0])
+        if len(words) == 3 and words[1].upper() == 'AS':
+            stage_names.add(words[2].lower())
+    return base_images
+
+
+@dataclass
+class BuildJob:
+    config_container: ConfigContainer
+    tag: str
+    image_name: str
+    base_images: List[str]
+    dependencies: Set[str] = field(default_factory=set)
+    status: str = 'pending'
+    duration: float = 0.0
+
+
+class BuildScheduler:
+    def __init__(self, quiet: bool = False, jobs: int = DEFAULT_BUILD_JOBS, no_cache: bool = False) -> None:
+        self.quiet = quiet
+        self.jobs = max(1, jobs)
+        self.no_cache = no_cache
+        self._output_lock = threading.Lock()
+
+    def create_jobs(self, config_containers: List[ConfigContainer]) -> Dict[str, BuildJob]:
+        docker_util = DockerUtil(self.quiet)
+        build_jobs = {}
+        for config_container in config_containers:
+            context = docker_util.get_image_context(config_container)
+            tag = docker_util.get_image_name(config_container)
+            image_name = normalize_image_reference(tag)
+            build_jobs[image_name] = BuildJob(
+                config_container=config_container,
+                tag=tag,
+                image_name=image_name,
+                base_images=[
+                    normalize_image_reference(base_image)
+                    for base_image in parse_base_images(os.path.join(context, config_container.build.dockerfile))
+                ]
+            )
+
+        # a Dockerfile starting FROM another docker-alias image has to wait for that build
+        for build_job in build_jobs.values():
+            build_job.dependencies = {
+                base_image for base_image in build_job.base_images
+                if base_image in build_jobs and base_image != build_job.image_name
+            }
+        return build_jobs
+
+    def get_output(self, build_job: BuildJob, prefix_width: int):
+        prefix = build_job.config_container.name.ljust(prefix_width) + ' | '
+
+        def output(line: str) -> None:
+            with self._output_lock:
+                print(prefix + line)
+                sys.stdout.flush()
+        return output
+
+    def pull_shared_base_images(self, build_jobs: Dict[str, BuildJob]) -> None:
+        # concurrent builds would otherwise all download a missing base they share
+        usage = {}
+        for build_job in build_jobs.values():
+            for base_image in set(build_job.base_images) - build_job.dependencies:
+                usage[base_image] = usage.get(base_image, 0) + 1
+        docker_util = DockerUtil(self.quiet)
+        shared_base_images = [
+            base_image for base_image, count in sorted(usage.items())
+            if count > 1 and not docker_util.image_reference_exists(base_image)
+        ]
+        if not shared_base_images:
+            return
+
+        def pull(base_image: str) -> None:
+            if not self.quiet:
+                with self._output_lock:
+                    print('Pulling shared base image ' + base_image)
+            try:
+                docker_util.loop_stream(docker_util.stream_pull(base_image), False)
+            except Exception as e:
+                # the build itself will report it again
+                with self._output_lock:
+                    print(e)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            list(executor.map(pull, shared_base_images))
+
+    def build(self, build_job: BuildJob, prefix_width: int) -> bool:
+        start = time.monotonic()
+        image_lock = DockerUtil.get_image_lock(build_job.tag)
+        image_lock.acquire()
+        try:
+            return DockerUtil(self.quiet).build_image(
+                build_job.config_container,
+                self.get_output(build_job, prefix_width),
+                self.no_cache
+            )
+        finally:
+            image_lock.release()
+            build_job.duration = time.monotonic() - start
+
+    def run(self, config_containers: List[ConfigContainer]) -> bool:
+        build_jobs = self.create_jobs(config_containers)
+        if not build_jobs:
+            return True
+        prefix_width = max(len(build_job.config_container.name) for build_job in build_jobs.values())
+        start = time.monotonic()
+        self.pull_shared_base_images(build_jobs)
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                self.dispatch_ready_jobs(build_jobs, running, executor, prefix_width)
+                if not running:
+                    break
+                self.collect_finished_jobs(running)
+
+        # whatever is still pending waits on a dependency cycle
+        for build_job in build_jobs.values():
+            if build_job.status == 'pending':
+                build_job.status = 'skipped'
+
+        if not self.quiet:
+            self.print_summary(build_jobs, time.monotonic() - start)
+        return all(build_job.status == 'built' for build_job in build_jobs.values())
+
+    def dispatch_ready_jobs(self, build_jobs: Dict[str, BuildJob], running: Dict[Future, BuildJob],
+                            executor: ThreadPoolExecutor, prefix_width: int) -> None:
+        for build_job in build_jobs.values():
+            if build_job.status != 'pending':
+                continue
+            dependency_states = {build_jobs[dependency].status for dependency in build_job.dependencies}
+            if dependency_states & {'failed', 'skipped'}:
+                build_job.status = 'skipped'
+            elif dependency_states <= {'built'}:
+                build_job.status = 'running'
+                running[executor.submit(self.build, build_job, prefix_width)] = build_job
+
+    @staticmethod
+    def collect_finished_jobs(running: Dict[Future, BuildJob]) -> None:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            build_job = running.pop(future)
+            build_job.status = 'built' if not future.exception() and future.result() else 'failed'
+
+    @staticmethod
+    def print_summary(build_jobs: Dict[str, BuildJob], total_duration: float) -> None:
+        name_width = max(len(build_job.config_container.name) for build_job in build_jobs.values())
+        print('')
+        for build_job in build_jobs.values():
+            print('{name}  {status:<7}  {duration:7.1f}s  {tag}'.format(
+                name=build_job.config_container.name.ljust(name_width),
+                status=build_job.status,
+                duration=build_job.duration,
+                tag=build_job.tag
+            ))
+        print('{name}  {status:<7}  {duration:7.1f}s'.format(
+            name='total'.ljust(name_width),
+            status='',
+            duration=total_duration
+        ))
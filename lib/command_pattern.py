@@ -0,0 +1,76 @@
+import re
+from fnmatch import fnmatchcase
+from typing import Dict, List, Optional, Tuple
+
+REGEX_PATTERN_PREFIX = 're:'
+GLOB_CHARACTERS = ('*', '?', '[')
+# on equal length a literal token beats a glob token, which beats a regex
+LITERAL_RANK = 2
+GLOB_RANK = 1
+REGEX_RANK = 0
+
+Specificity = Tuple[int, int, int]
+
+
+class TrieNode:
+    def __init__(self) -> None:
+        self.literal_children: Dict[str, 'TrieNode'] = {}
+        self.glob_children: List[Tuple[str, 'TrieNode']] = []
+        self.pattern_index: Optional[int] = None
+
+
+# patterns match the command line token by token, a token containing *, ? or [ is a glob for one token,
+# patterns starting with "re:" are regular expressions matched at the start of the command line
+class CommandPatternMatcher:
+    def __init__(self, patterns: List[str]) -> None:
+        self._root = TrieNode()
+        self._regexes: List[Tuple[int, re.Pattern]] = []
+        for pattern_index, pattern in enumerate(patterns):
+            if pattern.startswith(REGEX_PATTERN_PREFIX):
+                self._regexes.append((pattern_index, re.compile(pattern[len(REGEX_PATTERN_PREFIX):])))
+            else:
+                self.insert(pattern_index, pattern.split())
+
+    def insert(self, pattern_index: int, tokens: List[str]) -> None:
+        node = self._root
+        for token in tokens:
+            if any(character in token for character in GLOB_CHARACTERS):
+                child = next((child for glob, child in node.glob_children if glob == token), None)
+                if child is None:
+                    child = TrieNode()
+                    node.glob_children.append((token, child))
+            else:
+                child = node.literal_children.setdefault(token, TrieNode())
+            node = child
+        if node.pattern_index is None:
+            node.pattern_index = pattern_index
+
+    def match(self, command: str) -> Optional[int]:
+        best: Optional[Tuple[Specificity, int]] = None
+        tokens = command.split()
+        for specificity, pattern_index in self.match_trie(self._root, tokens, 0, 0):
+            best = self.choose(best, specificity, pattern_index)
+        for pattern_index, regex in self._regexes:
+            regex_match = regex.match(command)
+            if regex_match:
+                best = self.choose(best, (len(regex_match.group(0).split()), REGEX_RANK, 0), pattern_index)
+        return best[1] if best else None
+
+    def match_trie(self, node: TrieNode, tokens: List[str], depth: int, literals: int):
+        if node.pattern_index is not None and node is not self._root:
+            yield (depth, LITERAL_RANK if literals == depth else GLOB_RANK, literals), node.pattern_index
+        if depth == len(tokens):
+            return
+        token = tokens[depth]
+        if token in node.literal_children:
+            yield from self.match_trie(node.literal_children[token], tokens, depth + 1, literals + 1)
+        for glob, child in node.glob_children:
+            if fnmatchcase(token, glob):
+                yield from self.match_trie(child, tokens, depth + 1, literals)
+
+    @staticmethod
+    def choose(best: Optional[Tuple[Specificity, int]], specificity: Specificity, pattern_index: int):
+        # ties keep the pattern declared first
+        if best is None or specificity > best[0] or (specificity == best[0] and pattern_index < best[1]):
+            return specificity, pattern_index
+        return best
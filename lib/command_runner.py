@@ -0,0 +1,60 @@
+from typing import List, Optional
+
+from lib.config_container import ConfigContainer, ConfigContainerUtil, Command
+from lib.docker_util import DockerUtil
+from lib.execution_plan import ExecutionPlanWriter
+from lib.tracing import span
+
+
+class CommandRunner:
+    def __init__(self, quiet: bool = False) -> None:
+        self.quiet = quiet
+
+    def run(self, arguments: List[str]) -> int:
+        if len(arguments) == 0:
+            return 0
+
+        wanted_container = arguments[0]
+        if '/' in wanted_container:
+            wanted_container = wanted_container.split('/')[-1]
+        attributes = list(arguments[1:])
+
+        config_container_util = ConfigContainerUtil()
+        config_container_util.resolve_config_containers()
+        with span('command.lookup', command=wanted_container):
+            found = config_container_util.find_command(wanted_container)
+        if found:
+            config_container, command = found
+            # only the selected container needs its conditional config applied
+            with span('config.merge'):
+                config_container = config_container_util.merge_config_containers(
+                    config_container,
+                    ' '.join([wanted_container] + attributes)
+                )
+            return self.exec_docker(config_container_util, wanted_container, config_container, command, attributes)
+        if not self.quiet:
+            print('Container ' + wanted_container + ' not found!')
+        return 1
+
+    def exec_docker(
+            self,
+            config_container_util: ConfigContainerUtil,
+            wanted_container: str,
+            config_container: ConfigContainer,
+            command: Optional[Command],
+            attributes: List[str]
+    ) -> int:
+        response_code = DockerUtil(self.quiet).exec_docker(config_container, command=command, attributes=attributes)
+        try:
+            # the next call of the shim can run docker directly
+            with span('plan.write'):
+                ExecutionPlanWriter(self.quiet).write(
+                    wanted_container,
+                    config_container,
+                    command,
+                    config_container_util.file_key,
+                    config_container_util.variables
+                )
+        except OSError:
+            pass
+        return response_code
@@ -1,11 +1,11 @@
-import configparser
 import json
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional
 
-import yaml
+from lib.state_store import BUILD_HASHES, REGISTRATIONS, SETTINGS, StateStore
+from lib.variable_interpolation import VariableInterpolator
 
 VERSION = 'v2.4.9'
 YAML_CONFIG_FILE_NAME = 'docker-alias.yml'
@@ -14,128 +14,156 @@ DOCKER_ALIAS_HOME = os.path.join(str(Path.home()), '.local', 'docker-alias')
 SHIM_BINARY_DIR = os.path.join(DOCKER_ALIAS_HOME, 'bin')
 INI_CONFIG_DIR = os.path.join(str(Path.home()), '.config', 'docker-alias')
 INI_CONFIG_FILE_PATH = os.path.join(INI_CONFIG_DIR, INI_CONFIG_FILE_NAME)
+PLAN_DIR = os.path.join(INI_CONFIG_DIR, 'plans')
+STATE_DIR = os.path.join(INI_CONFIG_DIR, 'state')
 DEFAULT_WORKING_DIR = '/app'
+DEFAULT_IDLE_TIMEOUT = 900
 
 
+# the state of docker-alias: registered yaml files, settings and build hashes. Once kept in config.ini,
+# which is migrated into the state store on first use and not read afterwards.
 class INIConfig:
     yml_section_name = 'YamlPaths'
     settings_section_name = 'Settings'
+    build_hashes_section_name = 'ImageBuildHashes'
     enabled_option_name = 'enabled'
+    _migrated = False
+
+    def __init__(self, state_store: Optional[StateStore] = None) -> None:
+        self._state_store = state_store or StateStore(STATE_DIR)
 
     @staticmethod
     def get_config_dir():
-        if not os.path.isdir(INI_CONFIG_DIR):
-            os.mkdir(INI_CONFIG_DIR)
+        # concurrent first runs race to create it
+        os.makedirs(INI_CONFIG_DIR, exist_ok=True)
         return INI_CONFIG_DIR
 
     def get_config_file_path(self):
         return os.path.join(self.get_config_dir(), INI_CONFIG_FILE_NAME)
 
     def get_config(self):
-        config_dir = self.get_config_dir()
+        # config.ini is only read once to migrate it, importing configparser costs every invocation otherwise
+        import configparser
+
         config = configparser.ConfigParser()
-        config_path = self.get_config_file_path()
-        if not os.path.isfile(config_path):
-            Path(config_path).touch()
-        config.read(os.path.join(config_dir, INI_CONFIG_FILE_NAME))
+        config.read(self.get_config_file_path())
         return config
 
-    def get_yaml_paths(self) -> List[str]:
-        config = self.get_config()
+    def get_state_store(self) -> StateStore:
+        if not INIConfig._migrated:
+            self.migrate()
+            INIConfig._migrated = True
+        return self._state_store
+
+    def migrate(self) -> None:
+        # the registrations are written last, their file marks a finished migration
+        state_store = self._state_store
+        if state_store.exists(REGISTRATIONS):
+            return
+        with state_store.get_lock(REGISTRATIONS):
+            if state_store.exists(REGISTRATIONS):
+                return
+            config = self.get_config()
+            if config.has_section(self.build_hashes_section_name) and not state_store.exists(BUILD_HASHES):
+                with state_store.transaction(BUILD_HASHES) as build_hashes:
+                    for image_key, build_hash in config.items(self.build_hashes_section_name):
+                        build_hashes[image_key] = {'hash': build_hash, 'updated_at': 0}
+            if config.has_option(self.settings_section_name, self.enabled_option_name):
+                enabled = config.getboolean(self.settings_section_name, self.enabled_option_name, fallback=True)
+                state_store.set(SETTINGS, self.enabled_option_name, enabled)
+            path_list = []
+            if config.has_option(self.yml_section_name, 'list'):
+                path_list = json.loads(config.get(self.yml_section_name, 'list') or '[]')
+            state_store.write(REGISTRATIONS, {path: {} for path in path_list})
+
+    def get_watched_paths(self) -> List[str]:
+        state_store = self.get_state_store()
+        state_store.get_state_dir()
+        return [state_store.get_path(REGISTRATIONS), state_store.get_path(SETTINGS)]
 
-        path_list = []
-        if config.has_section(self.yml_section_name):
-            path_list_json = config.get(self.yml_section_name, 'list')
-            if path_list_json:
-                path_list = json.loads(path_list_json)
-        return path_list
+    def get_yaml_paths(self) -> List[str]:
+        return list(self.get_state_store().read(REGISTRATIONS))
 
     def add_yaml_path(self, path: str):
-        path_list = self.get_yaml_paths()
-        path_list.append(path)
-        self.save_path_list(path_list)
+        with self.get_state_store().transaction(REGISTRATIONS) as registrations:
+            registrations.setdefault(path, {})
 
     def remove_yaml_path(self, path: str):
-        path_list = self.get_yaml_paths()
-        new_path_list = []
-        for _path in path_list:
-            if not _path == path:
-                new_path_list.append(_path)
-        self.save_path_list(new_path_list)
-
-    def save_path_list(self, path_list: List[str]):
-        config = self.get_config()
-        if not config.has_section(self.yml_section_name):
-            config.add_section(self.yml_section_name)
-
-        path_list = list(set(path_list))  # deduplicate list
-        config.set(self.yml_section_name, 'list', json.dumps(path_list))
-        self.save_config(config)
-
-    def save_config(self, config):
-        with open(self.get_config_file_path(), 'w') as file:
-            config.write(file)
-            file.close()
+        with self.get_state_store().transaction(REGISTRATIONS) as registrations:
+            registrations.pop(path, None)
 
     def is_enabled(self) -> bool:
-        config = self.get_config()
-        if not config.has_section(self.settings_section_name):
-            return True
-        if not config.has_option(self.settings_section_name, self.enabled_option_name):
-            return True
-        return config.getboolean(self.settings_section_name, self.enabled_option_name, fallback=True)
+        return self.get_state_store().get(SETTINGS, self.enabled_option_name, True) is not False
 
     def set_enabled(self, enabled: bool) -> None:
-        config = self.get_config()
-        if not config.has_section(self.settings_section_name):
-            config.add_section(self.settings_section_name)
-        config.set(self.settings_section_name, self.enabled_option_name, 'true' if enabled else 'false')
-        self.save_config(config)
+        self.get_state_store().set(SETTINGS, self.enabled_option_name, enabled)
+
+    @staticmethod
+    def get_build_hash_key(image_name: str) -> str:
+        # the key config.ini used, so migrated hashes stay valid
+        return image_name.replace(':', '_')
+
+    def get_build_hash(self, image_name: str) -> Optional[str]:
+        return self.get_state_store().get_build_hash(self.get_build_hash_key(image_name))
+
+    def set_build_hash(self, image_name: str, build_hash: str) -> None:
+        self.get_state_store().set_build_hash(self.get_build_hash_key(image_name), build_hash)
 
 
 @dataclass
 class YAMLConfig:
     path: str
     config: dict
+    variables: Dict[str, Optional[str]] = field(default_factory=dict)
 
 
 class YAMLConfigUtil:
     def get_config(self, yaml_path) -> YAMLConfig:
+        # only needed when the config cache misses, importing yaml costs every invocation otherwise
+        import yaml
+
         with open(yaml_path, 'r') as stream:
-            yaml_string = self.replace_variables(yaml_path, stream.read())
+            variable_interpolator = self.get_variable_interpolator(yaml_path)
+            yaml_string = variable_interpolator.interpolate(stream.read())
             try:
                 return YAMLConfig(
                     path=yaml_path,
-                    config=yaml.safe_load(yaml_string)
+                    config=yaml.safe_load(yaml_string),
+                    variables=variable_interpolator.dependencies
                 )
             except yaml.YAMLError:
                 return None
 
     @staticmethod
-    def replace_variables(yaml_path: str, yaml_string: str) -> str:
-        for environment_variable in os.environ:
-            yaml_string = yaml_string.replace('$' + environment_variable, os.getenv(environment_variable))
+    def get_variable_interpolator(yaml_path: str) -> VariableInterpolator:
+        # environment variables take precedence over the built-in ones
+        return VariableInterpolator(os.environ, {
+            'YAML_LOCATION_DIR': os.path.dirname(os.path.realpath(yaml_path)),
+            'UID': str(os.getuid()),
+            'DEFAULT_WORKING_DIR': DEFAULT_WORKING_DIR,
+        })
 
-        yaml_string = yaml_string.replace('$YAML_LOCATION_DIR', os.path.dirname(os.path.realpath(yaml_path)))
-        yaml_string = yaml_string.replace('$UID', str(os.getuid()))
-        yaml_string = yaml_string.replace('$DEFAULT_WORKING_DIR', DEFAULT_WORKING_DIR)
-        return yaml_string
+    def replace_variables(self, yaml_path: str, yaml_string: str) -> str:
+        return self.get_variable_interpolator(yaml_path).interpolate(yaml_string)
 
     def find_yaml_configs(self) -> List[YAMLConfig]:
-        config_list = self.find_yaml_configs_recursive(Path(os.getcwd()))
-        config_list = sorted(config_list, key=lambda x: len(x.path), reverse=True)
-        return config_list
+        return [self.get_config(yaml_path) for yaml_path in self.find_yaml_paths()]
+
+    def find_yaml_paths(self) -> List[str]:
+        path_list = self.find_yaml_paths_recursive(Path(os.getcwd()))
+        path_list = sorted(path_list, key=len, reverse=True)
+        return path_list
 
-    def find_yaml_configs_recursive(self, path: Path) -> List[YAMLConfig]:
+    def find_yaml_paths_recursive(self, path: Path) -> List[str]:
         if path.parent.absolute() == path:
             return []
 
-        yaml_configs = []
+        yaml_paths = []
         yaml_path = os.path.join(path, YAML_CONFIG_FILE_NAME)
         if os.path.isfile(yaml_path):
-            yaml_configs.append(self.get_config(yaml_path))
+            yaml_paths.append(yaml_path)
 
         if path.parent.absolute():
-            yaml_configs = yaml_configs + self.find_yaml_configs_recursive(path.parent.absolute())
+            yaml_paths = yaml_paths + self.find_yaml_paths_recursive(path.parent.absolute())
 
-        return yaml_configs
+        return yaml_paths
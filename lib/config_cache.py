@@ -0,0 +1,74 @@
+import hashlib
+import os
+import pickle
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from lib.config import INI_CONFIG_DIR, VERSION, YAMLConfig
+from lib.file_util import atomic_write
+
+CONFIG_CACHE_DIR = os.path.join(INI_CONFIG_DIR, 'cache')
+CONFIG_CACHE_FORMAT = 7
+
+FileKey = Tuple[Tuple[str, int, int, int], ...]
+
+
+@dataclass
+class ConfigCacheEntry:
+    schema: tuple
+    file_key: FileKey
+    variables: Dict[str, Optional[str]]
+    payload: Any
+
+
+class ConfigCache:
+    def __init__(self, schema: tuple, cache_dir: str = CONFIG_CACHE_DIR) -> None:
+        self._schema = (VERSION, CONFIG_CACHE_FORMAT, os.getuid()) + tuple(schema)
+        self._cache_dir = cache_dir
+
+    def get_cache_path(self, yaml_paths: List[str]) -> str:
+        chain_hash = hashlib.sha1('\0'.join(yaml_paths).encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, 'config-' + chain_hash + '.pickle')
+
+    @staticmethod
+    def get_file_key(yaml_paths: List[str]) -> FileKey:
+        file_key = []
+        for yaml_path in yaml_paths:
+            stat = os.stat(yaml_path)
+            file_key.append((yaml_path, stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        return tuple(file_key)
+
+    def load(self, yaml_paths: List[str]) -> Optional[ConfigCacheEntry]:
+        try:
+            with open(self.get_cache_path(yaml_paths), 'rb') as file:
+                entry = pickle.load(file)
+            file_key = self.get_file_key(yaml_paths)
+        except Exception:
+            return None
+
+        if not isinstance(entry, ConfigCacheEntry) or entry.schema != self._schema or entry.file_key != file_key:
+            return None
+        for name, value in entry.variables.items():
+            if os.environ.get(name) != value:
+                return None
+        return entry
+
+    def store(self, file_key: FileKey, yaml_configs: List[YAMLConfig], payload: Any) -> ConfigCacheEntry:
+        variables = {}
+        for yaml_config in yaml_configs:
+            variables.update(yaml_config.variables)
+
+        entry = ConfigCacheEntry(
+            schema=self._schema,
+            file_key=file_key,
+            variables=variables,
+            payload=payload
+        )
+        try:
+            atomic_write(
+                self.get_cache_path([path for path, *_ in file_key]),
+                pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+            )
+        except OSError:
+            pass
+        return entry
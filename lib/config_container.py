@@ -1,18 +1,31 @@
 import hashlib
 import os
 import re
-from copy import copy
-from dataclasses import dataclass
-from typing import List
-
-from lib.config import YAMLConfig, YAMLConfigUtil, DEFAULT_WORKING_DIR
+import sys
+from copy import copy, deepcopy
+from dataclasses import dataclass, fields
+from typing import Dict, List, Optional, Tuple
+
+from lib.command_pattern import CommandPatternMatcher
+from lib.config import YAMLConfig, YAMLConfigUtil, DEFAULT_WORKING_DIR, DEFAULT_IDLE_TIMEOUT
+from lib.config_cache import ConfigCache, FileKey
+from lib.tracing import span
 from lib.volume import Volume, VolumeWithDriver, SimpleVolume
 
+# options a command_pattern_conditional_config entry may overwrite, volumes are resolved separately
+CONDITIONAL_OPTIONS = (
+    'entrypoint', 'env_file', 'post_exec_hook_command', 'pre_exec_hook_command', 'quiet', 'working_dir',
+    'environment', 'user', 'inject_user_switcher', 'networks', 'ports', 'stay_in_root'
+)
+CONDITIONAL_BOOLEAN_OPTIONS = ('quiet', 'inject_user_switcher', 'stay_in_root')
+
 
 @dataclass
 class Build:
     context: str
     dockerfile: str
+    cache_from: List[str]
+    inline_cache: bool
 
 
 @dataclass
@@ -47,6 +60,7 @@ class ConditionalConfigContainer:
 
 @dataclass
 class ConfigContainer(AbstractConfigContainer):
+    auto_network: bool
     auto_rebuild_images: bool
     image: str
     privileged: bool
@@ -54,17 +68,97 @@ class ConfigContainer(AbstractConfigContainer):
     commands: List[Command]
     docker_compose_project_name: str
     keep_volumes: bool
+    volume_grace_period: int
     name: str
+    persistent: bool
+    idle_timeout: int
     fs_location: str
     fs_location_hash: str
     conditional_config_containers: List[ConditionalConfigContainer]
 
 
 class ConfigContainerUtil:
+    # the yaml files and environment variables the last resolved containers were built from
+    file_key: FileKey = ()
+    variables: Dict[str, Optional[str]] = {}
+    # command or container name -> (container index, command index or None)
+    command_index: Dict[str, Tuple[int, Optional[int]]] = {}
+    config_containers: List['ConfigContainer'] = []
+
+    def __init__(self) -> None:
+        # keyed by id(), the values keep the containers alive
+        self._command_pattern_matchers: Dict[int, Tuple[ConfigContainer, CommandPatternMatcher]] = {}
+        self._merged_config_containers: Dict[Tuple[int, int], ConfigContainer] = {}
+
     def resolve_config_containers(self) -> List[ConfigContainer]:
-        yaml_configs = YAMLConfigUtil().find_yaml_configs()
-        containers = self.build_config_containers_from_yaml_configs(yaml_configs)
-        return containers
+        yaml_config_util = YAMLConfigUtil()
+        with span('config.discover') as discover_span:
+            yaml_paths = yaml_config_util.find_yaml_paths()
+            discover_span.set(files=len(yaml_paths))
+        config_cache = ConfigCache(self.get_cache_schema())
+
+        with span('config.cache_load') as cache_span:
+            cache_entry = config_cache.load(yaml_paths)
+            cache_span.set(hit=cache_entry is not None)
+        if cache_entry is None:
+            with span('config.parse'):
+                file_key = config_cache.get_file_key(yaml_paths)
+                yaml_configs = [yaml_config_util.get_config(yaml_path) for yaml_path in yaml_paths]
+                containers = self.build_config_containers_from_yaml_configs(yaml_configs)
+                payload = (containers, self.build_command_index(containers))
+            with span('config.cache_store'):
+                cache_entry = config_cache.store(file_key, yaml_configs, payload)
+
+        self.file_key = cache_entry.file_key
+        self.variables = cache_entry.variables
+        self.config_containers, self.command_index = cache_entry.payload
+        return self.config_containers
+
+    @staticmethod
+    def build_command_index(containers: List[ConfigContainer]) -> Dict[str, Tuple[int, Optional[int]]]:
+        # containers of deeper yaml files come first and win, within one file a name must be unique
+        index = {}
+        for container_index, config_container in enumerate(containers):
+            entries = [
+                (command.name, (container_index, command_index))
+                for command_index, command in enumerate(config_container.commands or [])
+            ]
+            entries.append((config_container.name, (container_index, None)))
+            for name, entry in entries:
+                if name not in index:
+                    index[name] = entry
+                    continue
+                existing_container = containers[index[name][0]]
+                if existing_container is not config_container \
+                        and existing_container.fs_location == config_container.fs_location:
+                    print(
+                        'Warning: {name} is defined by containers {first} and {second} in {path}, using {first}'.format(
+                            name=name,
+                            first=existing_container.name,
+                            second=config_container.name,
+                            path=config_container.fs_location
+                        ),
+                        file=sys.stderr
+                    )
+        return index
+
+    def find_command(self, name: str) -> Optional[Tuple[ConfigContainer, Optional[Command]]]:
+        if name not in self.command_index:
+            return None
+        container_index, command_index = self.command_index[name]
+        config_container = self.config_containers[container_index]
+        if command_index is None:
+            return config_container, None
+        return config_container, config_container.commands[command_index]
+
+    @staticmethod
+    def get_cache_schema() -> tuple:
+        return tuple(
+            (dataclass_type.__name__, tuple(field.name for field in fields(dataclass_type)))
+            for dataclass_type in (
+                ConfigContainer, ConditionalConfigContainer, Build, Command, SimpleVolume, VolumeWithDriver
+            )
+        )
 
     def build_config_containers_from_yaml_configs(self, yaml_configs: List[YAMLConfig]) -> List[ConfigContainer]:
         containers = []
@@ -89,9 +183,12 @@ class ConfigContainerUtil:
         for container_name, config in configs.items():
             build = None
             if config.get('build', {}):
+                cache_from = config.get('build').get('cache_from') or []
                 build = Build(
                     context=config.get('build').get('context'),
-                    dockerfile=config.get('build').get('dockerfile')
+                    dockerfile=config.get('build').get('dockerfile') or 'Dockerfile',
+                    cache_from=[cache_from] if isinstance(cache_from, str) else cache_from,
+                    inline_cache=bool(config.get('build').get('inline_cache', False))
                 )
 
             fs_location = os.path.dirname(os.path.realpath(yaml_config.path))
@@ -100,6 +197,7 @@ class ConfigContainerUtil:
             docker_compose_project_name = base_cleaned = re.split(r"[-_]", os.path.basename(fs_location))[0]
 
             config_container = ConfigContainer(
+                auto_network=bool(config.get('auto_network', True)),
                 auto_rebuild_images=bool(config.get('auto_rebuild_images', True)),
                 privileged=bool(config.get('privileged', True)),
                 build=build,
@@ -109,7 +207,10 @@ class ConfigContainerUtil:
                 env_file=config.get('env_file'),
                 image=config.get('image'),
                 keep_volumes=bool(yaml_config.config.get('keep_volumes', False)),
+                volume_grace_period=int(yaml_config.config.get('volume_grace_period', 0)),
                 name=container_name,
+                persistent=bool(config.get('persistent', False)),
+                idle_timeout=int(config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)),
                 post_exec_hook_command=config.get('post_exec_hook_command'),
                 pre_exec_hook_command=config.get('pre_exec_hook_command'),
                 quiet=bool(config.get('quiet', False)),
@@ -178,75 +279,66 @@ class ConfigContainerUtil:
     def build_conditional_config_container(self, global_volumes, config)\
             -> List[ConditionalConfigContainer]:
         conditional_config_containers = []
-        if config.get('command_pattern_conditional_config'):
-            for conditional_config in config.get('command_pattern_conditional_config', []):
-                pattern = list(conditional_config.keys())[0]
-                conditional_config = conditional_config
-
-                overwrite = {}
-                if 'entrypoint' in conditional_config.keys():
-                    overwrite['entrypoint'] = conditional_config.get('entrypoint')
-
-                if 'env_file' in conditional_config.keys():
-                    overwrite['env_file'] = conditional_config.get('env_file')
-
-                if 'post_exec_hook_command' in conditional_config.keys():
-                    overwrite['post_exec_hook_command'] = conditional_config.get('post_exec_hook_command')
-
-                if 'pre_exec_hook_command' in conditional_config.keys():
-                    overwrite['pre_exec_hook_command'] = conditional_config.get('pre_exec_hook_command')
-
-                if 'quiet' in conditional_config.keys():
-                    overwrite['quiet'] = bool(conditional_config.get('quiet', False))
-
-                if 'working_dir' in conditional_config.keys():
-                    overwrite['working_dir'] = conditional_config.get('working_dir', DEFAULT_WORKING_DIR)
-
-                if 'volumes' in conditional_config.keys():
-                    overwrite['volumes'] = self.build_volumes(conditional_config, global_volumes)
-
-                if 'environment' in conditional_config.keys():
-                    overwrite['environment'] = conditional_config.get('environment', [])
-
-                if 'user' in conditional_config.keys():
-                    overwrite['user'] = conditional_config.get('user', None)
-
-                if 'inject_user_switcher' in conditional_config.keys():
-                    overwrite['inject_user_switcher'] = bool(conditional_config.get('inject_user_switcher', False))
-
-                if 'networks' in conditional_config.keys():
-                    overwrite['networks'] = conditional_config.get('networks', [])
-
-                if 'ports' in conditional_config.keys():
-                    overwrite['ports'] = conditional_config.get('ports', [])
-
-                if 'stay_in_root' in conditional_config.keys():
-                    overwrite['stay_in_root'] = bool(conditional_config.get('stay_in_root', False))
-
-                conditional_config_container = ConditionalConfigContainer(
-                    command_pattern=pattern,
-                    overwrite=overwrite
-                )
-                conditional_config_containers.append(conditional_config_container)
+        for conditional_config in config.get('command_pattern_conditional_config') or []:
+            pattern = list(conditional_config.keys())[0]
+            # the options are either nested under the pattern or, in the flat format, next to it
+            if isinstance(conditional_config[pattern], dict):
+                conditional_config = conditional_config[pattern]
+
+            conditional_config_container = ConditionalConfigContainer(
+                command_pattern=pattern,
+                overwrite=self.build_conditional_overwrite(global_volumes, conditional_config)
+            )
+            conditional_config_containers.append(conditional_config_container)
         return conditional_config_containers
 
-    def merge_config_containers(self, config_container: ConfigContainer, command: str):
-        for conditional_config_container in config_container.conditional_config_containers:
-            if command.startswith(conditional_config_container.command_pattern):
-                return self._merge_config_containers(config_container, conditional_config_container)
-        return config_container
+    def build_conditional_overwrite(self, global_volumes, conditional_config) -> dict:
+        overwrite = {}
+        for option in CONDITIONAL_OPTIONS:
+            if option in conditional_config.keys():
+                value = conditional_config.get(option)
+                overwrite[option] = bool(value) if option in CONDITIONAL_BOOLEAN_OPTIONS else value
+
+        if 'volumes' in conditional_config.keys():
+            overwrite['volumes'] = self.build_volumes(conditional_config, global_volumes)
+        return overwrite
+
+    def get_command_pattern_matcher(self, config_container: ConfigContainer) -> CommandPatternMatcher:
+        if id(config_container) not in self._command_pattern_matchers:
+            self._command_pattern_matchers[id(config_container)] = (config_container, CommandPatternMatcher([
+                conditional_config_container.command_pattern
+                for conditional_config_container in config_container.conditional_config_containers
+            ]))
+        return self._command_pattern_matchers[id(config_container)][1]
+
+    def merge_config_containers(self, config_container: ConfigContainer, command: str) -> ConfigContainer:
+        if not config_container.conditional_config_containers:
+            return config_container
+        pattern_index = self.get_command_pattern_matcher(config_container).match(command)
+        if pattern_index is None:
+            return config_container
+
+        key = (id(config_container), pattern_index)
+        if key not in self._merged_config_containers:
+            self._merged_config_containers[key] = self._merge_config_containers(
+                config_container,
+                config_container.conditional_config_containers[pattern_index]
+            )
+        return self._merged_config_containers[key]
 
     @staticmethod
     def _merge_config_containers(
             config_container: ConfigContainer,
             conditional_config_container: ConditionalConfigContainer
     ) -> ConfigContainer:
+        # the resolved container is shared, overrides go to a shallow copy and replace values instead of mutating them
+        config_container = copy(config_container)
         for attr, new_value in conditional_config_container.overwrite.items():
             if new_value is None:
                 continue
             current_value = getattr(config_container, attr, None)
             if isinstance(current_value, dict) and isinstance(new_value, dict):
-                merged = copy.deepcopy(current_value)
+                merged = deepcopy(current_value)
                 for key, val in new_value.items():
                     if key in merged and isinstance(merged[key], dict) and isinstance(val, dict):
                         merged[key].update(val)
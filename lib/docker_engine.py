@@ -0,0 +1,234 @@
+import json
+import os
+import socket
+import threading
+from typing import List, Optional, Tuple
+from urllib.parse import quote, urlencode, urlparse
+
+from lib.tracing import span
+
+DEFAULT_DOCKER_HOST = 'unix:///var/run/docker.sock'
+DEFAULT_REGISTRY = 'docker.io'
+DEFAULT_TAG = 'latest'
+
+
+def normalize_image_reference(reference: str) -> str:
+    # node, node:latest and docker.io/library/node:latest all name the same image
+    name, _, digest = reference.partition('@')
+    tag = None
+    last_slash = name.rfind('/')
+    if ':' in name[last_slash + 1:]:
+        name, tag = name.rsplit(':', 1)
+
+    domain, _, remainder = name.partition('/')
+    if not remainder or ('.' not in domain and ':' not in domain and domain != 'localhost'):
+        domain, remainder = DEFAULT_REGISTRY, name
+    if domain == DEFAULT_REGISTRY and '/' not in remainder:
+        remainder = 'library/' + remainder
+
+    name = domain + '/' + remainder
+    if digest:
+        return name + '@' + digest
+    return name + ':' + (tag or DEFAULT_TAG)
+
+
+class DockerEngineError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__('Docker Engine returned {status}: {message}'.format(status=status, message=message))
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPResponse:
+    def __init__(self, status: int, data: bytes) -> None:
+        self.status = status
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+
+# the engine socket only needs plain HTTP/1.1, http.client would also import ssl and email on every run
+class UnixHTTPConnection:
+    def __init__(self, socket_path: str, timeout: float) -> None:
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._sock = None
+        self._file = None
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self._timeout)
+        sock.connect(self._socket_path)
+        self._sock = sock
+        self._file = sock.makefile('rb')
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+        if self._sock:
+            self._sock.close()
+        self._sock = self._file = None
+
+    def request(self, method: str, url: str, body: bytes = None, headers: dict = None) -> None:
+        if self._sock is None:
+            self.connect()
+        lines = ['{method} {url} HTTP/1.1'.format(method=method, url=url), 'Host: localhost']
+        lines += ['{name}: {value}'.format(name=name, value=value) for name, value in (headers or {}).items()]
+        if body is not None or method in ('POST', 'PUT'):
+            lines.append('Content-Length: {length}'.format(length=len(body or b'')))
+        self._sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+
+    def getresponse(self) -> UnixHTTPResponse:
+        status_line = self._file.readline()
+        if not status_line:
+            raise ConnectionResetError('Docker Engine closed the connection')
+        status = int(status_line.split()[1])
+        headers = {}
+        for line in iter(self._file.readline, b'\r\n'):
+            if not line:
+                raise ConnectionResetError('Docker Engine closed the connection')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        data = self.read_body(status, headers)
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return UnixHTTPResponse(status, data)
+
+    def read_body(self, status: int, headers: dict) -> bytes:
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self._file.readline().split(b';')[0], 16)
+                chunks.append(self.read_exactly(size))
+                self._file.readline()
+                if not size:
+                    return b''.join(chunks)
+        if 'content-length' in headers:
+            return self.read_exactly(int(headers['content-length']))
+        if status in (204, 304) or status < 200:
+            return b''
+        # without a length the body ends with the connection
+        data = self._file.read()
+        self.close()
+        return data
+
+    def read_exactly(self, size: int) -> bytes:
+        data = self._file.read(size)
+        if len(data) < size:
+            raise ConnectionResetError('Docker Engine closed the connection')
+        return data
+
+
+class DockerEngineClient:
+    def __init__(self, base_url: str = DEFAULT_DOCKER_HOST, timeout: float = 60) -> None:
+        self._base_url = base_url
+        self._timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls) -> 'DockerEngineClient':
+        return cls(os.environ.get('DOCKER_HOST') or DEFAULT_DOCKER_HOST)
+
+    def _connect(self):
+        url = urlparse(self._base_url)
+        if url.scheme == 'unix':
+            return UnixHTTPConnection(url.path, self._timeout)
+        import http.client
+        if os.environ.get('DOCKER_TLS_VERIFY'):
+            import ssl
+            cert_path = os.environ.get('DOCKER_CERT_PATH', os.path.join(os.path.expanduser('~'), '.docker'))
+            context = ssl.create_default_context(cafile=os.path.join(cert_path, 'ca.pem'))
+            context.load_cert_chain(os.path.join(cert_path, 'cert.pem'), os.path.join(cert_path, 'key.pem'))
+            return http.client.HTTPSConnection(url.hostname, url.port or 2376, timeout=self._timeout, context=context)
+        return http.client.HTTPConnection(url.hostname, url.port or 2375, timeout=self._timeout)
+
+    def close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection:
+            connection.close()
+        self._local.connection = None
+
+    def request(self, method: str, path: str, query: dict = None, body: dict = None) -> Tuple[int, bytes]:
+        # unversioned paths are served at the engine's own api version, a pinned version is rejected as too old
+        # by new engines and as too new by old ones
+        url = path
+        if query:
+            url = url + '?' + urlencode(query)
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        with span('docker.api', method=method, path=path) as api_span:
+            # an idle keep-alive connection may have been closed by the engine, retry once on a fresh one
+            for attempt in range(2):
+                connection = getattr(self._local, 'connection', None)
+                reused = connection is not None
+                if not reused:
+                    connection = self._local.connection = self._connect()
+                try:
+                    connection.request(method, url, body=payload, headers=headers)
+                    response = connection.getresponse()
+                    api_span.set(status=response.status)
+                    return response.status, response.read()
+                # http.client.RemoteDisconnected is a ConnectionResetError as well
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close()
+                    if not reused or attempt:
+                        raise
+
+    def request_json(self, method: str, path: str, query: dict = None, body: dict = None, allow_missing=False):
+        status, data = self.request(method, path, query, body)
+        if allow_missing and status == 404:
+            return None
+        if status >= 400:
+            message = data.decode('utf-8', 'replace')
+            try:
+                message = json.loads(data).get('message', message)
+            except ValueError:
+                pass
+            raise DockerEngineError(status, message)
+        if not data:
+            return {}
+        return json.loads(data)
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        return quote(name, safe='/:@')
+
+    @staticmethod
+    def _filters(filters: dict) -> dict:
+        return {'filters': json.dumps(filters)} if filters else {}
+
+    def inspect_image(self, reference: str) -> Optional[dict]:
+        return self.request_json('GET', '/images/' + self._quote(reference) + '/json', allow_missing=True)
+
+    def inspect_container(self, name: str) -> Optional[dict]:
+        return self.request_json('GET', '/containers/' + self._quote(name) + '/json', allow_missing=True)
+
+    def list_containers(self, filters: dict = None) -> List[dict]:
+        return self.request_json('GET', '/containers/json', dict(all='1', **self._filters(filters)))
+
+    def remove_container(self, name: str, force: bool = False) -> bool:
+        query = {'force': '1'} if force else None
+        return self.request_json('DELETE', '/containers/' + self._quote(name), query, allow_missing=True) is not None
+
+    def inspect_volume(self, name: str) -> Optional[dict]:
+        return self.request_json('GET', '/volumes/' + self._quote(name), allow_missing=True)
+
+    def create_volume(self, name: str, driver: str = None, driver_opts: dict = None) -> dict:
+        return self.request_json('POST', '/volumes/create', body={
+            'Name': name,
+            'Driver': driver or 'local',
+            'DriverOpts': driver_opts or {},
+        })
+
+    def remove_volume(self, name: str, force: bool = False) -> bool:
+        query = {'force': '1'} if force else None
+        return self.request_json('DELETE', '/volumes/' + self._quote(name), query, allow_missing=True) is not None
+
+    def list_networks(self, filters: dict = None) -> List[dict]:
+        return self.request_json('GET', '/networks', self._filters(filters))
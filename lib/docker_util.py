@@ -1,19 +1,22 @@
 import os.path
-import pty
-import select
+import re
+import signal
 import subprocess
 import sys
 import termios
 import tty
-from typing import List
+from typing import Callable, Dict, List, Optional
 
-import docker
-from checksumdir import dirhash
-
-from lib.config import INIConfig, DEFAULT_WORKING_DIR, DOCKER_ALIAS_HOME
+from lib.config import INIConfig, DEFAULT_WORKING_DIR, DOCKER_ALIAS_HOME, INI_CONFIG_DIR
 from lib.config_container import ConfigContainer, Command
+from lib.docker_engine import DockerEngineClient, DockerEngineError, normalize_image_reference
+from lib.file_util import FileLock
+from lib.tracing import span
 from lib.volume import VolumeWithDriver, SimpleVolume
-from subprocess import Popen
+from lib.volume_manager import VolumeManager
+
+IMAGE_LOCK_DIR = os.path.join(INI_CONFIG_DIR, 'locks')
+PASSTHROUGH_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT)
 
 
 class DockerUtil:
@@ -21,36 +24,128 @@ class DockerUtil:
     def __init__(self, quiet: bool):
         self.quiet = quiet
 
-    client = docker.from_env()
+    _client = None
+    _engine = None
+    _image_index = {}
+    _network_cache: Dict[str, bool] = {}
     volume_name_pattern = 'docker_alias_{fs_location_hash}_{volume_name}'
     container_name_pattern = 'docker_alias_{fs_location_hash}_{container_name}'
+    unique_container_name_pattern = '{container_name}_{pid}_{suffix}'
     image_name_pattern = 'docker_alias_{fs_location_hash}_{container_name}:latest'
     quiet = False
     container_name = None
+    persistent_container_manager = None
+
+    @classmethod
+    def reset_after_fork(cls):
+        # connections must not be shared with the parent, e.g. when docker-alias-daemon forks a run request
+        DockerUtil._client = None
+        DockerUtil._engine = None
+        cls.reset_caches()
+
+    @classmethod
+    def reset_caches(cls):
+        # only valid for one invocation, long running callers like the daemon's prefetcher start over per pass
+        DockerUtil._image_index = {}
+        DockerUtil._network_cache = {}
+
+    @classmethod
+    def get_client(cls):
+        # the docker sdk is only needed for streaming builds and pulls
+        if cls._client is None:
+            import docker
+            DockerUtil._client = docker.from_env()
+        return cls._client
+
+    @classmethod
+    def get_engine(cls) -> DockerEngineClient:
+        if cls._engine is None:
+            DockerUtil._engine = DockerEngineClient.from_env()
+        return cls._engine
 
     def exec_docker(self, config_container: ConfigContainer, command: Command = None, attributes: List = None) -> int:
         if attributes is None:
             attributes = []
-        config_container.image = self.handle_image(config_container)
-        self.remove_container(config_container)
-        self.create_volumes(config_container)
-        response_code = self.exec_docker_subprocess(config_container, command, attributes)
-        if not config_container.keep_volumes:
-            self.remove_volumes(config_container)
-        self.remove_container(config_container)
+        with span('image.prepare', container=config_container.name):
+            config_container.image = self.handle_image(config_container)
+        volume_manager = VolumeManager(self)
+        with span('volumes.acquire'):
+            volume_manager.acquire(config_container)
+        remove_volumes = not config_container.keep_volumes
+        try:
+            if config_container.persistent and self.acquire_persistent_container(config_container):
+                # the persistent container keeps its volumes mounted
+                remove_volumes = False
+                try:
+                    return self.exec_docker_container(config_container, command, attributes)
+                finally:
+                    self.persistent_container_manager.release()
+                    self.persistent_container_manager = None
+            response_code = self.exec_docker_container(config_container, command, attributes)
+            with span('container.cleanup'):
+                self.remove_container(config_container)
+        finally:
+            with span('volumes.release'):
+                volume_manager.release(config_container, remove=remove_volumes)
+        return response_code
+
+    def acquire_persistent_container(self, config_container: ConfigContainer) -> bool:
+        from lib.persistent_container import PersistentContainerManager
+
+        persistent_container_manager = PersistentContainerManager(self)
+        with span('persistent.acquire') as persistent_span:
+            acquired = persistent_container_manager.acquire(config_container)
+            persistent_span.set(acquired=acquired)
+        if acquired:
+            self.persistent_container_manager = persistent_container_manager
+        return acquired
+
+    def exec_docker_container(self, config_container: ConfigContainer, command: Command, attributes: List) -> int:
+        # from the docker cli start to the exit of the container, the time of the command itself included
+        with span('container.run') as run_span:
+            response_code = self.exec_docker_subprocess(config_container, command, attributes)
+            run_span.set(exit_code=response_code)
         return response_code
 
     def handle_image(self, config_container: ConfigContainer) -> str:
         if config_container.build:
             image_name = self.get_image_name(config_container)
-            if not self.image_exists(config_container) or self.image_needs_rebuild(config_container):
-                self.build_image(config_container)
+            self.prepare_image_once(
+                image_name,
+                lambda: self.image_exists(config_container) and not self.image_needs_rebuild(config_container),
+                lambda: self.build_image(config_container)
+            )
         else:
             image_name = config_container.image
-            if not self.external_image_exists(config_container):
-                self.pull_image(config_container)
+            self.prepare_image_once(
+                image_name,
+                lambda: self.external_image_exists(config_container),
+                lambda: self.pull_image(config_container)
+            )
         return image_name
 
+    @staticmethod
+    def get_image_lock(image_name: str) -> FileLock:
+        file_name = re.sub(r'[^A-Za-z0-9_.-]', '_', normalize_image_reference(image_name)) + '.lock'
+        return FileLock(os.path.join(IMAGE_LOCK_DIR, file_name))
+
+    def prepare_image_once(self, image_name: str, is_ready: Callable[[], bool], prepare: Callable[[], object]):
+        # concurrent invocations would all build or pull the same image, one does it while the others wait
+        if is_ready():
+            return
+        image_lock = self.get_image_lock(image_name)
+        if not image_lock.acquire(blocking=False):
+            if not self.quiet:
+                print('Waiting for another docker-alias process to prepare ' + image_name, file=sys.stderr)
+            with span('image.wait', image=image_name):
+                image_lock.acquire()
+        try:
+            self.forget_image(image_name)
+            if not is_ready():
+                prepare()
+        finally:
+            image_lock.release()
+
     def image_needs_rebuild(self, config_container: ConfigContainer) -> bool:
         if not config_container.build.context.startswith('.'):
             return False
@@ -60,10 +155,7 @@ class DockerUtil:
 
         image_name = self.get_image_name(config_container)
 
-        config = INIConfig().get_config()
-        existing_hash = None
-        if config.has_section('ImageBuildHashes'):
-            existing_hash = config.get('ImageBuildHashes', image_name.replace(':', '_'))
+        existing_hash = INIConfig().get_build_hash(image_name)
         if not existing_hash:
             return True
 
@@ -72,56 +164,93 @@ class DockerUtil:
         return False
 
     def image_exists(self, config_container: ConfigContainer) -> bool:
-        image_name = self.get_image_name(config_container)
-        for image in self.client.images.list(all=True):
-            if image_name in image.tags:
-                return True
-        return False
+        return self.image_reference_exists(self.get_image_name(config_container))
 
     def external_image_exists(self, config_container: ConfigContainer) -> bool:
-        image_name = config_container.image
-        for image in self.client.images.list(all=True):
-            if image_name in image.tags:
-                return True
-        return False
+        return self.image_reference_exists(config_container.image)
+
+    def image_reference_exists(self, image_name: str) -> bool:
+        reference = normalize_image_reference(image_name)
+        if reference not in self._image_index:
+            self._image_index[reference] = self.get_engine().inspect_image(reference) is not None
+        return self._image_index[reference]
+
+    def forget_image(self, image_name: str):
+        self._image_index.pop(normalize_image_reference(image_name), None)
 
     def pull_image(self, config_container: ConfigContainer):
         if not self.quiet and not config_container.quiet:
             print('Pulling Image ' + config_container.image)
-        image_name = config_container.image
-        parts = image_name.rsplit(":", 1)
-        if len(parts) > 1:
-            output_streamer = self.client.api.pull(parts[0], parts[1])
+        with span('image.pull', image=config_container.image):
+            output_streamer = self.stream_pull(config_container.image)
             self.loop_stream(output_streamer, not self.quiet)
-            return
-        output_streamer = self.client.api.pull(image_name)
-        self.loop_stream(output_streamer, not self.quiet)
 
-    def build_image(self, config_container: ConfigContainer):
-        image_name = self.get_image_name(config_container)
-        if not self.quiet and not config_container.quiet:
-            print('Building Image ' + image_name)
-        context = self.get_image_context(config_container)
-        low_level_api = self.client.api
+    def stream_pull(self, image_name: str):
+        self.forget_image(image_name)
+        parts = image_name.rsplit(":", 1)
+        if len(parts) > 1 and '/' not in parts[1]:
+            return self.get_client().api.pull(parts[0], parts[1], stream=True, decode=True)
+        return self.get_client().api.pull(image_name, stream=True, decode=True)
 
-        try:
-            output_streamer = low_level_api.build(
-                decode=True,
-                tag=image_name,
-                path=context,
-                dockerfile=os.path.join(context, config_container.build.dockerfile),
-                rm=True,
-                nocache=True
-            )
-            self.loop_stream(output_streamer, not self.quiet)
+    def build_image(
+            self,
+            config_container: ConfigContainer,
+            output: Callable[[str], None] = print,
+            no_cache: bool = False
+    ) -> bool:
+        image_name = self.get_image_name(config_container)
+        with span('image.build', image=image_name):
+            if not self.quiet and not config_container.quiet:
+                output('Building Image ' + image_name)
+            context = self.get_image_context(config_container)
+            low_level_api = self.get_client().api
+            self.forget_image(image_name)
+
+            try:
+                build_args = {}
+                if config_container.build.inline_cache:
+                    build_args['BUILDKIT_INLINE_CACHE'] = '1'
+                cache_from = None
+                if config_container.build.cache_from:
+                    # an explicit cache_from replaces the local layer cache, the previous build stays usable
+                    cache_from = [image_name] + self.pull_cache_from_images(config_container, output)
+                output_streamer = low_level_api.build(
+                    decode=True,
+                    tag=image_name,
+                    path=context,
+                    dockerfile=os.path.join(context, config_container.build.dockerfile),
+                    rm=True,
+                    nocache=no_cache,
+                    cache_from=cache_from,
+                    buildargs=build_args
+                )
+                error = self.loop_stream(output_streamer, not self.quiet, output)
+                if error:
+                    output(error)
+                    return False
+
+                build_hash = self.hash_docker_build_dir(config_container)
+                INIConfig().set_build_hash(image_name, build_hash)
+            except Exception as e:
+                output(str(e))
+                return False
+            return True
 
-            config = INIConfig().get_config()
-            if not config.has_section('ImageBuildHashes'):
-                config.add_section('ImageBuildHashes')
-            config.set('ImageBuildHashes', image_name.replace(':', '_'), self.hash_docker_build_dir(config_container))
-            INIConfig().save_config(config)
-        except Exception as e:
-            print(e)
+    def pull_cache_from_images(self, config_container: ConfigContainer, output: Callable[[str], None]) -> List[str]:
+        # the classic builder only reuses layers of cache images that exist locally
+        cache_from = []
+        for image_name in config_container.build.cache_from:
+            if not self.image_reference_exists(image_name):
+                try:
+                    error = self.loop_stream(self.stream_pull(image_name), False)
+                except Exception as e:
+                    error = str(e)
+                if error:
+                    if not self.quiet:
+                        output('Could not pull cache image ' + image_name + ': ' + error)
+                    continue
+            cache_from.append(image_name)
+        return cache_from
 
     def get_image_name(self, config_container: ConfigContainer) -> str:
         return self.image_name_pattern.format(
@@ -135,133 +264,95 @@ class DockerUtil:
         if config_container.build.context == '.':
             return config_container.fs_location
         if config_container.build.context.startswith('./'):
-            return config_container.fs_location + context[2:]
+            return os.path.join(config_container.fs_location, context[2:])
         if config_container.build.context.startswith('/'):
             return config_container.build.context
 
         return os.path.join(config_container.fs_location, context)
 
     def hash_docker_build_dir(self, config_container: ConfigContainer):
+        from lib.build_context import BuildContextFingerprint
+
         context = self.get_image_context(config_container)
-        path = os.path.dirname(os.path.join(context, config_container.build.dockerfile))
-        return dirhash(path, 'md5')
+        with span('image.fingerprint', context=context):
+            return BuildContextFingerprint().get_fingerprint(
+                context,
+                os.path.join(context, config_container.build.dockerfile)
+            )
 
     def remove_container(self, config_container: ConfigContainer):
-        container_name = self.get_container_name(config_container)
-        for current_container in self.client.containers.list(all=True):
-            if container_name == current_container.name:
-                current_container.remove()
+        # docker run --rm normally removed it already, this only catches containers left behind
+        try:
+            self.get_engine().remove_container(self.get_container_name(config_container), force=True)
+        except DockerEngineError as e:
+            if e.status != 409:  # removal already in progress
+                raise
 
     def get_container_name(self, config_container: ConfigContainer):
+        # pids repeat across pid namespaces, e.g. CI jobs in containers sharing one engine, the 64 bit suffix does not
         if self.container_name is None:
-            container_name = self.container_name_pattern.format(
-            fs_location_hash=config_container.fs_location_hash,
-            container_name=config_container.name,
+            self.container_name = self.unique_container_name_pattern.format(
+                container_name=self.container_name_pattern.format(
+                    fs_location_hash=config_container.fs_location_hash,
+                    container_name=config_container.name,
+                ),
+                pid=os.getpid(),
+                suffix=os.urandom(8).hex()
             )
-            count = 0
-            for current_container in self.client.containers.list(all=True):
-                if container_name in current_container.name:
-                    count = count + 1
-            self.container_name = container_name + '_' + str(count)
         return self.container_name
 
-    def create_volumes(self, container):
-        if container.volumes:
-            for volume in container.volumes:
-                if isinstance(volume, VolumeWithDriver):
-                    volume_name = self.volume_name_pattern.format(
-                        fs_location_hash=container.fs_location_hash,
-                        volume_name=volume.name
-                    )
-                    if not self.volume_exists(volume_name):
-                        self.create_volume(volume_name, volume)
-
-    def remove_volumes(self, container):
-        if container.volumes:
-            for volume in container.volumes:
-                if isinstance(volume, VolumeWithDriver):
-                    volume_name = self.volume_name_pattern.format(
-                        fs_location_hash=container.fs_location_hash,
-                        container_name=self.get_container_name(container),
-                        volume_name=volume.name
-                    )
-                    self.remove_volume(volume_name)
-
-    def volume_exists(self, volume_name) -> bool:
-        for volume in self.client.volumes.list():
-            if volume.name == volume_name:
-                return True
-        return False
-
-    def create_volume(self, volume_name: str, volume: VolumeWithDriver):
-        self.client.volumes.create(
-            volume_name,
-            driver=volume.driver,
-            driver_opts=volume.driver_opts
-        )
-
-    def remove_volume(self, volume_name: str):
-        for volume in self.client.volumes.list():
-            if volume.name == volume_name:
-                volume.remove(True)
-
     def exec_docker_subprocess(self, container, command: Command = None, attributes: List = None) -> int:
+        if not (os.isatty(sys.stdin.fileno()) and os.isatty(sys.stdout.fileno())):
+            return self.exec_docker_subprocess_passthrough(container, command, attributes)
         try:
             old_tty = termios.tcgetattr(sys.stdin)
             tty.setraw(sys.stdin.fileno())
             return self.exec_docker_subprocess_tty(old_tty, container, command, attributes)
         except termios.error:
-            return self.exec_docker_subprocess_stdout_pipe(container, command, attributes)
+            return self.exec_docker_subprocess_passthrough(container, command, attributes)
 
     def exec_docker_subprocess_tty(self, old_tty, container, command: Command = None, attributes: List = None):
+        from lib.pty_relay import PtyRelay
+
         try:
-            # open pseudo-terminal to interact with subprocess
-            master_fd, slave_fd = pty.openpty()
-            # use os.setsid() make it run in a new process group, or bash job control will not be enabled
-            p = Popen(
-                self.build_command(container, command, attributes, _tty=True),
-                preexec_fn=os.setsid,
-                stdin=slave_fd,
-                stdout=slave_fd,
-                stderr=slave_fd,
-                universal_newlines=True
+            return PtyRelay(sys.stdin.fileno(), sys.stdout.fileno()).run(
+                self.build_command(container, command, attributes, _tty=True)
             )
-
-            while p.poll() is None:
-                r, w, e = select.select([sys.stdin, master_fd], [], [], 0.2)
-                if sys.stdin in r:
-                    d = os.read(sys.stdin.fileno(), 10240)
-                    os.write(master_fd, d)
-                elif master_fd in r:
-                    o = os.read(master_fd, 10240)
-                    if o:
-                        os.write(sys.stdout.fileno(), o)
         finally:
             # restore tty settings back
             termios.tcsetattr(sys.stdin, termios.TCSAFLUSH, old_tty)
-        return p.poll()
 
-    def exec_docker_subprocess_stdout_pipe(self, container, command: Command = None, attributes: List = None):
+    def exec_docker_subprocess_passthrough(self, container, command: Command = None, attributes: List = None) -> int:
+        # docker reads and writes our stdin, stdout and stderr directly, nothing is copied in between
+        sys.stdout.flush()
+        sys.stderr.flush()
         process = subprocess.Popen(
             self.build_command(container, command, attributes, _tty=False),
-            preexec_fn=os.setsid,
-            stdout=subprocess.PIPE,
-            universal_newlines=True
+            start_new_session=True
         )
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print(output.strip())
-        return process.poll()
+        previous_handlers = {}
+        try:
+            for signal_number in PASSTHROUGH_SIGNALS:
+                previous_handlers[signal_number] = signal.signal(
+                    signal_number,
+                    lambda number, frame: process.send_signal(number)
+                )
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            pass
+        try:
+            return process.wait()
+        finally:
+            for signal_number, previous_handler in previous_handlers.items():
+                signal.signal(signal_number, previous_handler)
 
     def build_command(
             self,
             config_container: ConfigContainer,
             command: Command = None,
             attributes: List = None,
-            _tty: bool = True
+            _tty: bool = True,
+            interactive: bool = True
     ) -> List[str]:
         if attributes is None:
             attributes = []
@@ -272,6 +363,11 @@ class DockerUtil:
             if command.path:
                 internal_command = command.path
 
+        if self.persistent_container_manager:
+            return self.persistent_container_manager.build_exec_command(
+                config_container, internal_command, command, attributes, self.get_terminal_arguments(_tty, interactive)
+            )
+
         cmd_base = [
             'docker',
             'run',
@@ -279,16 +375,40 @@ class DockerUtil:
             '--rm',
             '--name=' + self.get_container_name(config_container),
         ]
-        if _tty:
-            cmd_base = cmd_base + ['-it']
+        cmd_base = cmd_base + self.get_terminal_arguments(_tty, interactive)
         cmd_base = cmd_base + self.build_docker_run_arguments(config_container)
         cmd_base.append(config_container.image)
         if config_container.inject_user_switcher:
             cmd_base = cmd_base + ['/switch_user']
         cmd_base.append(internal_command)
-        return cmd_base + command.default_params + attributes
+        if command:
+            cmd_base = cmd_base + command.default_params
+        return cmd_base + attributes
+
+    @staticmethod
+    def get_terminal_arguments(_tty: bool, interactive: bool) -> List[str]:
+        if _tty and interactive:
+            return ['-it']
+        if interactive:
+            return ['-i']
+        if _tty:
+            return ['-t']
+        return []
 
     def build_docker_run_arguments(self, config_container: ConfigContainer) -> List[str]:
+        arguments = self.build_mount_arguments(config_container)
+
+        if config_container.entrypoint:
+            arguments.append('--entrypoint')
+            arguments.append(config_container.entrypoint)
+
+        return arguments \
+            + self.build_environment_arguments(config_container) \
+            + self.build_network_arguments(config_container) \
+            + self.build_working_dir_arguments(config_container) \
+            + self.build_user_arguments(config_container)
+
+    def build_mount_arguments(self, config_container: ConfigContainer) -> List[str]:
         arguments = []
         for volume in config_container.volumes:
             volume_mount_pattern = '{source}:{target}'
@@ -316,11 +436,11 @@ class DockerUtil:
         if config_container.inject_user_switcher and os.path.isfile(user_switcher_binary):
             arguments.append('-v')
             arguments.append('{user_switcher_binary}:/switch_user'.format(user_switcher_binary=user_switcher_binary))
+        return arguments
 
-        if config_container.entrypoint:
-            arguments.append('--entrypoint')
-            arguments.append(config_container.entrypoint)
-
+    @staticmethod
+    def build_environment_arguments(config_container: ConfigContainer) -> List[str]:
+        arguments = []
         if config_container.env_file:
             arguments.append('--env-file')
             arguments.append(os.path.join(config_container.fs_location, config_container.env_file))
@@ -332,11 +452,14 @@ class DockerUtil:
 
         arguments.append('-e')
         arguments.append("UID_HOST=" + str(os.getuid()))
+        return arguments
 
-        for network in self.client.networks.list():
-            if network.name == config_container.docker_compose_project_name + "_default":
-                arguments.append('--network')
-                arguments.append(network.name)
+    def build_network_arguments(self, config_container: ConfigContainer) -> List[str]:
+        arguments = []
+        compose_network = self.get_compose_network(config_container)
+        if compose_network:
+            arguments.append('--network')
+            arguments.append(compose_network)
 
         for network in config_container.networks:
             if not network == 'default':
@@ -346,26 +469,39 @@ class DockerUtil:
         for port in config_container.ports:
             arguments.append('-p')
             arguments.append(port)
+        return arguments
 
+    def build_working_dir_arguments(self, config_container: ConfigContainer) -> List[str]:
         if not config_container.stay_in_root:
-            arguments.append('-w')
-            arguments.append(self.calculate_path_segment(config_container))
-        elif config_container.working_dir:
-            arguments.append('-w')
-            arguments.append(config_container.working_dir)
-        else:
-            arguments.append('-w')
-            arguments.append(DEFAULT_WORKING_DIR)
+            return ['-w', self.calculate_path_segment(config_container)]
+        if config_container.working_dir:
+            return ['-w', config_container.working_dir]
+        return ['-w', DEFAULT_WORKING_DIR]
 
+    @staticmethod
+    def build_user_arguments(config_container: ConfigContainer) -> List[str]:
+        arguments = []
         if config_container.user:
             arguments.append('--user')
             arguments.append(config_container.user)
 
         if config_container.privileged:
             arguments.append('--privileged')
-
         return arguments
 
+    def get_compose_network(self, config_container: ConfigContainer) -> Optional[str]:
+        if not config_container.auto_network:
+            return None
+        network_name = config_container.docker_compose_project_name + '_default'
+        if network_name not in self._network_cache:
+            # the name filter matches substrings, so the exact name is checked on the result
+            with span('network.lookup', network=network_name):
+                networks = self.get_engine().list_networks({'name': [network_name]})
+            self._network_cache[network_name] = any(network['Name'] == network_name for network in networks)
+        if self._network_cache[network_name]:
+            return network_name
+        return None
+
     @staticmethod
     def calculate_path_segment(config_container: ConfigContainer) -> str:
         current_dir = os.getcwd()
@@ -377,8 +513,15 @@ class DockerUtil:
         return os.path.join(DEFAULT_WORKING_DIR, path_segment)
 
     @staticmethod
-    def loop_stream(streamer, verbose: bool):
+    def loop_stream(streamer, verbose: bool, output: Callable[[str], None] = print) -> Optional[str]:
+        error = None
         for chunk in streamer:
             if verbose and 'stream' in chunk:
                 for line in chunk['stream'].splitlines():
-                    print(line.strip('\n'))
+                    output(line.strip('\n'))
+            if 'error' in chunk:
+                error = chunk['error'].strip()
+        return error
+
+
+os.register_at_fork(after_in_child=DockerUtil.reset_after_fork)
@@ -0,0 +1,161 @@
+import os
+import shlex
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from lib.config import PLAN_DIR, VERSION, YAML_CONFIG_FILE_NAME
+from lib.config_cache import FileKey
+from lib.config_container import ConfigContainer, Command
+from lib.docker_util import DockerUtil
+from lib.file_util import atomic_write
+from lib.volume import VolumeWithDriver
+
+# the compose network can appear or vanish at any time, plans depending on its discovery expire quickly
+NETWORK_PLAN_TTL = 30
+# file timestamps may be too coarse to notice an edit made right after the plan was written
+MIN_CONFIG_AGE = 2
+# a plan per command and working directory piles up, plans not rewritten for this long are removed
+PLAN_TTL = 7 * 24 * 60 * 60
+PLAN_PRUNE_INTERVAL = 24 * 60 * 60
+PLAN_PRUNE_MARKER = '.pruned'
+
+
+def get_plan_path(command_name: str, cwd: str, plan_dir: str = PLAN_DIR) -> str:
+    return plan_dir + '/' + command_name + cwd.rstrip('/') + '.plan'
+
+
+def get_logical_cwd() -> str:
+    # shims only know $PWD, which keeps symlinked path segments
+    cwd = os.getcwd()
+    pwd = os.environ.get('PWD')
+    try:
+        if pwd and os.path.samefile(pwd, cwd):
+            return pwd
+    except OSError:
+        pass
+    return cwd
+
+
+class ExecutionPlanWriter:
+    def __init__(self, quiet: bool = False, plan_dir: str = PLAN_DIR) -> None:
+        self.quiet = quiet
+        self._plan_dir = plan_dir
+
+    @staticmethod
+    def is_plannable(config_container: ConfigContainer) -> bool:
+        if config_container.conditional_config_containers or config_container.persistent:
+            return False
+        if config_container.build and config_container.auto_rebuild_images:
+            return False
+        if not config_container.keep_volumes:
+            for volume in config_container.volumes:
+                if isinstance(volume, VolumeWithDriver):
+                    return False
+        return True
+
+    @staticmethod
+    def is_unchanged(file_key: FileKey) -> bool:
+        newest_allowed = time.time_ns() - MIN_CONFIG_AGE * 10 ** 9
+        for path, mtime_ns, size, inode in file_key:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if (stat.st_mtime_ns, stat.st_size, stat.st_ino) != (mtime_ns, size, inode) or mtime_ns > newest_allowed:
+                return False
+        return True
+
+    def write(
+            self,
+            command_name: str,
+            config_container: ConfigContainer,
+            command: Optional[Command],
+            file_key: FileKey,
+            variables: Dict[str, Optional[str]]
+    ) -> None:
+        if not self.is_plannable(config_container) or not self.is_unchanged(file_key):
+            return
+
+        docker_util = DockerUtil(self.quiet)
+        argv = docker_util.build_command(config_container, command, _tty=False, interactive=False)
+        name_index = argv.index('--name=' + docker_util.get_container_name(config_container))
+        expires = 0
+        if config_container.auto_network:
+            expires = int(time.time()) + NETWORK_PLAN_TTL
+
+        yaml_paths = [path for path, *_ in file_key]
+        lines = [
+            'plan_version=' + shlex.quote(VERSION),
+            'plan_expires=' + str(expires),
+            'plan_files=' + self.render_array(yaml_paths),
+            'plan_absent=' + self.render_array(self.get_absent_yaml_paths(yaml_paths)),
+            'plan_env=' + self.render_array(self.render_variables(variables)),
+            'plan_docker=' + self.render_array(argv[:name_index]),
+            'plan_name=' + shlex.quote(docker_util.container_name_pattern.format(
+                fs_location_hash=config_container.fs_location_hash,
+                container_name=config_container.name
+            )),
+            'plan_args=' + self.render_array(argv[name_index + 1:]),
+        ]
+        atomic_write(
+            get_plan_path(command_name, get_logical_cwd(), self._plan_dir),
+            ('\n'.join(lines) + '\n').encode('utf-8')
+        )
+        self.prune()
+
+    def prune(self) -> None:
+        if self.start_pruning():
+            self.remove_stale_plans(time.time() - PLAN_TTL)
+
+    def start_pruning(self) -> bool:
+        # at most once per interval, the marker is touched first so concurrent writers do not all walk the tree
+        marker_path = os.path.join(self._plan_dir, PLAN_PRUNE_MARKER)
+        try:
+            if time.time() - os.path.getmtime(marker_path) < PLAN_PRUNE_INTERVAL:
+                return False
+        except OSError:
+            pass
+        with open(marker_path, 'a'):
+            pass
+        os.utime(marker_path)
+        return True
+
+    def remove_stale_plans(self, oldest_allowed: float) -> None:
+        for directory, _, file_names in os.walk(self._plan_dir, topdown=False):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                try:
+                    if file_name != PLAN_PRUNE_MARKER and os.path.getmtime(path) < oldest_allowed:
+                        os.remove(path)
+                except OSError:
+                    pass
+            if directory != self._plan_dir:
+                try:
+                    # only succeeds for directories left empty
+                    os.rmdir(directory)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def get_absent_yaml_paths(yaml_paths: List[str]) -> List[str]:
+        # a docker-alias.yml created in any of these directories would change the resolved config
+        absent_yaml_paths = []
+        path = Path(os.getcwd())
+        while path.parent != path:
+            yaml_path = os.path.join(path, YAML_CONFIG_FILE_NAME)
+            if yaml_path not in yaml_paths:
+                absent_yaml_paths.append(yaml_path)
+            path = path.parent
+        return absent_yaml_paths
+
+    @staticmethod
+    def render_variables(variables: Dict[str, Optional[str]]) -> List[str]:
+        rendered = []
+        for name, value in sorted(variables.items()):
+            rendered = rendered + [name, '0' if value is None else '1', value or '']
+        return rendered
+
+    @staticmethod
+    def render_array(values: List[str]) -> str:
+        return '(' + ' '.join(shlex.quote(value) for value in values) + ')'
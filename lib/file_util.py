@@ -0,0 +1,72 @@
+import fcntl
+import os
+from typing import Optional
+
+
+def atomic_write(path: str, data: bytes, mode: Optional[int] = None) -> None:
+    import tempfile
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FileLock:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._fd = None
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        while True:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(self._fd, operation)
+            except BlockingIOError:
+                return False
+            # the previous holder may have removed the file, a lock on it no longer excludes anyone
+            if self.is_current():
+                return True
+            os.close(self._fd)
+            self._fd = None
+
+    def is_current(self) -> bool:
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return False
+        locked_stat = os.fstat(self._fd)
+        return (stat.st_dev, stat.st_ino) == (locked_stat.st_dev, locked_stat.st_ino)
+
+    def remove(self) -> None:
+        # only while holding the lock exclusively, processes waiting for it then lock a new file
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
@@ -0,0 +1,134 @@
+import ctypes
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, Optional, Set
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+IN_IGNORED = 0x00008000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_DEBOUNCE = 0.2
+DEFAULT_POLL_INTERVAL = 2
+
+
+class PollingFileWatcher:
+    def __init__(self, debounce: float = DEFAULT_DEBOUNCE, interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        self._debounce = debounce
+        self._interval = interval
+        self._signatures: Dict[str, Optional[tuple]] = {}
+
+    @staticmethod
+    def _signature(path: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def watch(self, paths: Iterable[str]) -> None:
+        self._signatures = {path: self._signature(path) for path in paths}
+
+    def _changed(self) -> bool:
+        return any(self._signature(path) != signature for path, signature in self._signatures.items())
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._changed():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self._interval)
+        time.sleep(self._debounce)
+        return True
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyFileWatcher:
+    def __init__(self, libc, debounce: float = DEFAULT_DEBOUNCE) -> None:
+        self._libc = libc
+        self._debounce = debounce
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches: Dict[int, str] = {}
+        self._files: Dict[str, Set[str]] = {}
+
+    def watch(self, paths: Iterable[str]) -> None:
+        # editors replace files by renaming, so the containing directories are watched instead of the files
+        files: Dict[str, Set[str]] = {}
+        for path in paths:
+            path = os.path.abspath(path)
+            files.setdefault(os.path.dirname(path), set()).add(os.path.basename(path))
+
+        for wd, directory in list(self._watches.items()):
+            if directory not in files:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+        watched_directories = set(self._watches.values())
+        for directory in files:
+            if directory not in watched_directories:
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+                if wd >= 0:
+                    self._watches[wd] = directory
+        self._files = files
+
+    def _read_events(self) -> bool:
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return False
+
+        relevant = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            directory = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                # a watched directory disappeared, watches removed via watch() are already forgotten
+                relevant = relevant or self._watches.pop(wd, None) is not None
+            elif directory is not None and name in self._files.get(directory, ()):
+                relevant = True
+        return relevant
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                return False
+            if self._read_events():
+                break
+
+        # collapse bursts of events (save, chmod, rename) into a single change
+        while select.select([self._fd], [], [], self._debounce)[0]:
+            self._read_events()
+        return True
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def create_file_watcher(debounce: float = DEFAULT_DEBOUNCE):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if hasattr(libc, 'inotify_init1'):
+            return InotifyFileWatcher(libc, debounce)
+    except OSError:
+        pass
+    return PollingFileWatcher(debounce)
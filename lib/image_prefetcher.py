@@ -0,0 +1,145 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from lib.build_scheduler import parse_base_images
+from lib.config import INIConfig, YAMLConfigUtil
+from lib.config_container import ConfigContainer, ConfigContainerUtil
+from lib.docker_engine import normalize_image_reference
+from lib.docker_util import DockerUtil
+
+DEFAULT_PULL_JOBS = 4
+PROGRESS_INTERVAL = 0.1
+
+
+def collect_registered_config_containers(ini_config: Optional[INIConfig] = None) -> List[ConfigContainer]:
+    ini_config = ini_config or INIConfig()
+    yaml_config_util = YAMLConfigUtil()
+    config_container_util = ConfigContainerUtil()
+    config_containers = []
+    for yaml_path in ini_config.get_yaml_paths():
+        if not os.path.isfile(yaml_path):
+            continue
+        yaml_config = yaml_config_util.get_config(yaml_path)
+        if yaml_config and yaml_config.config:
+            config_containers = config_containers \
+                + config_container_util.build_config_containers_from_yaml_config(yaml_config)
+    return config_containers
+
+
+def collect_external_images(config_containers: List[ConfigContainer]) -> List[str]:
+    docker_util = DockerUtil(True)
+    local_images = {
+        normalize_image_reference(docker_util.get_image_name(config_container))
+        for config_container in config_containers
+    }
+    images = []
+    for config_container in config_containers:
+        if config_container.build:
+            context = docker_util.get_image_context(config_container)
+            images = images \
+                + parse_base_images(os.path.join(context, config_container.build.dockerfile)) \
+                + config_container.build.cache_from
+        elif config_container.image:
+            images.append(config_container.image)
+    return [image for image in dict.fromkeys(images) if normalize_image_reference(image) not in local_images]
+
+
+class PullProgress:
+    def __init__(self, images: List[str], quiet: bool) -> None:
+        self._quiet = quiet
+        self._interactive = sys.stdout.isatty()
+        self._lock = threading.Lock()
+        self._layers: Dict[str, Dict[str, Tuple[int, int]]] = {image: {} for image in images}
+        self._finished: Dict[str, Optional[str]] = {}
+        self._last_render = 0.0
+
+    def update(self, image: str, chunk: dict) -> None:
+        layer_id = chunk.get('id')
+        if not layer_id or layer_id == image.rsplit(':', 1)[-1]:
+            return
+        detail = chunk.get('progressDetail') or {}
+        with self._lock:
+            layers = self._layers[image]
+            current, total = layers.get(layer_id, (0, 0))
+            if chunk.get('status') == 'Downloading' and detail.get('total'):
+                current, total = detail.get('current', 0), detail['total']
+            elif chunk.get('status') in ('Download complete', 'Pull complete', 'Already exists'):
+                current = total
+            layers[layer_id] = (current, total)
+            self.render()
+
+    def finish(self, image: str, error: Optional[str]) -> None:
+        with self._lock:
+            self._finished[image] = error
+            if not self._quiet:
+                if self._interactive:
+                    sys.stdout.write('\r\033[K')
+                if error:
+                    print('Failed to pull ' + image + ': ' + error)
+                else:
+                    print('Pulled ' + image)
+            self.render(force=True)
+
+    def render(self, force: bool = False) -> None:
+        if self._quiet or not self._interactive:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_render < PROGRESS_INTERVAL:
+            return
+        self._last_render = now
+        current = sum(layer[0] for layers in self._layers.values() for layer in layers.values())
+        total = sum(layer[1] for layers in self._layers.values() for layer in layers.values())
+        sys.stdout.write('\r\033[KPulling {done}/{count} images, {current:.1f}/{total:.1f} MB'.format(
+            done=len(self._finished),
+            count=len(self._layers),
+            current=current / 1000 ** 2,
+            total=total / 1000 ** 2
+        ))
+        sys.stdout.flush()
+
+    def close(self) -> None:
+        if not self._quiet and self._interactive:
+            sys.stdout.write('\r\033[K')
+            sys.stdout.flush()
+
+
+class ImagePrefetcher:
+    def __init__(self, quiet: bool = False, jobs: int = DEFAULT_PULL_JOBS) -> None:
+        self.quiet = quiet
+        self.jobs = max(1, jobs)
+
+    def pull(self, images: List[str], progress: PullProgress) -> bool:
+        def pull_image(image: str) -> Optional[str]:
+            error = None
+            image_lock = DockerUtil.get_image_lock(image)
+            image_lock.acquire()
+            try:
+                for chunk in DockerUtil(True).stream_pull(image):
+                    if 'error' in chunk:
+                        error = chunk['error'].strip()
+                    progress.update(image, chunk)
+            except Exception as e:
+                error = str(e)
+            finally:
+                image_lock.release()
+            progress.finish(image, error)
+            return error
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            errors = [error for error in executor.map(pull_image, images) if error]
+        progress.close()
+        return not errors
+
+    def run(self, images: List[str], missing_only: bool = False) -> bool:
+        # images removed since the last pass must not count as present
+        DockerUtil.reset_caches()
+        if missing_only:
+            docker_util = DockerUtil(True)
+            images = [image for image in images if not docker_util.image_reference_exists(image)]
+        if not images:
+            return True
+        return self.pull(images, PullProgress(images, self.quiet))
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+from lib.config import INI_CONFIG_DIR, DEFAULT_IDLE_TIMEOUT
+from lib.config_container import ConfigContainer, Command
+from lib.docker_engine import DockerEngineClient
+from lib.file_util import FileLock
+from lib.volume_manager import VolumeManager
+
+PERSISTENT_STATE_DIR = os.path.join(INI_CONFIG_DIR, 'persistent')
+PERSISTENT_LABEL = 'docker-alias.persistent'
+FINGERPRINT_LABEL = 'docker-alias.fingerprint'
+IDLE_TIMEOUT_LABEL = 'docker-alias.idle-timeout'
+# driver volumes that are removed together with the container, empty with keep_volumes
+VOLUMES_LABEL = 'docker-alias.volumes'
+# keeps the container alive without doing anything, --init makes it stop promptly
+IDLE_COMMAND = ['sh', '-c', 'while :; do sleep 3600; done']
+
+
+class PersistentContainerManager:
+    container_name_pattern = '{container_name}_persistent'
+
+    def __init__(self, docker_util, state_dir: str = PERSISTENT_STATE_DIR) -> None:
+        self._docker_util = docker_util
+        self._state_dir = state_dir
+        self._lock = None
+        self._container_name = None
+
+    def get_container_name(self, config_container: ConfigContainer) -> str:
+        return self.container_name_pattern.format(
+            container_name=self._docker_util.container_name_pattern.format(
+                fs_location_hash=config_container.fs_location_hash,
+                container_name=config_container.name
+            )
+        )
+
+    def get_lock(self, container_name: str) -> FileLock:
+        return FileLock(os.path.join(self._state_dir, container_name + '.lock'))
+
+    def get_start_lock(self, container_name: str) -> FileLock:
+        # held while the container is checked and started, also keeps the reaper out meanwhile
+        return FileLock(os.path.join(self._state_dir, container_name + '.start.lock'))
+
+    def get_image_entrypoint(self, config_container: ConfigContainer) -> List[str]:
+        # docker exec does not apply the image entrypoint, but docker run did
+        if config_container.entrypoint:
+            return [config_container.entrypoint]
+        image = self._docker_util.get_engine().inspect_image(config_container.image) or {}
+        return (image.get('Config') or {}).get('Entrypoint') or []
+
+    def get_fingerprint(self, config_container: ConfigContainer) -> str:
+        image = self._docker_util.get_engine().inspect_image(config_container.image) or {}
+        return hashlib.sha1(json.dumps([
+            image.get('Id'),
+            self.build_start_arguments(config_container),
+            config_container.idle_timeout,
+        ]).encode('utf-8')).hexdigest()
+
+    def build_start_arguments(self, config_container: ConfigContainer) -> List[str]:
+        # like docker run, part of the fingerprint so containers started without it are replaced
+        arguments = ['--pid=host'] \
+            + self._docker_util.build_mount_arguments(config_container) \
+            + self._docker_util.build_network_arguments(config_container)
+        if config_container.privileged:
+            arguments.append('--privileged')
+        return arguments
+
+    def build_start_command(self, config_container: ConfigContainer, fingerprint: str) -> List[str]:
+        return [
+            'docker',
+            'run',
+            '-d',
+            '--rm',
+            '--init',
+            '--name=' + self.get_container_name(config_container),
+            '--label', PERSISTENT_LABEL + '=1',
+            '--label', FINGERPRINT_LABEL + '=' + fingerprint,
+            '--label', IDLE_TIMEOUT_LABEL + '=' + str(config_container.idle_timeout),
+            '--label', VOLUMES_LABEL + '=' + self.get_removed_volumes(config_container),
+        ] + self.build_start_arguments(config_container) + [
+            '--entrypoint', IDLE_COMMAND[0],
+            config_container.image,
+        ] + IDLE_COMMAND[1:]
+
+    def get_removed_volumes(self, config_container: ConfigContainer) -> str:
+        if config_container.keep_volumes:
+            return ''
+        volumes = VolumeManager(self._docker_util).get_volumes(config_container)
+        return ','.join(volume_name for volume_name, _ in volumes)
+
+    def build_exec_command(
+            self,
+            config_container: ConfigContainer,
+            internal_command: str,
+            command: Optional[Command],
+            attributes: List[str],
+            terminal_arguments: List[str]
+    ) -> List[str]:
+        cmd_base = ['docker', 'exec'] + terminal_arguments
+        cmd_base = cmd_base \
+            + self._docker_util.build_environment_arguments(config_container) \
+            + self._docker_util.build_working_dir_arguments(config_container) \
+            + self._docker_util.build_user_arguments(config_container)
+        cmd_base.append(self.get_container_name(config_container))
+        cmd_base = cmd_base + self.get_image_entrypoint(config_container)
+        if config_container.inject_user_switcher:
+            cmd_base = cmd_base + ['/switch_user']
+        cmd_base.append(internal_command)
+        if command:
+            cmd_base = cmd_base + command.default_params
+        return cmd_base + attributes
+
+    def is_running(self, container_name: str, fingerprint: str) -> bool:
+        container = self._docker_util.get_engine().inspect_container(container_name)
+        if not container or not container['State']['Running']:
+            return False
+        return (container['Config'].get('Labels') or {}).get(FINGERPRINT_LABEL) == fingerprint
+
+    def acquire(self, config_container: ConfigContainer) -> bool:
+        # holds a shared lock for the duration of the command, restarts and reaping need it exclusively
+        container_name = self._container_name = self.get_container_name(config_container)
+        fingerprint = self.get_fingerprint(config_container)
+        self._lock = self.get_lock(container_name)
+        self._lock.acquire(shared=True)
+        self.touch(container_name)
+        if self.is_running(container_name, fingerprint):
+            return True
+
+        # flock cannot upgrade a shared lock atomically, so concurrent callers would all fail the upgrade,
+        # instead one of them starts the container while the others wait for it
+        self._lock.release()
+        with self.get_start_lock(container_name):
+            if not self.is_running(container_name, fingerprint):
+                if not self._lock.acquire(blocking=False):
+                    # another command still runs in the outdated container
+                    self.release()
+                    return False
+                if not self.start_container(config_container, container_name, fingerprint):
+                    self.release()
+                    return False
+            self._lock.acquire(shared=True)
+        return True
+
+    def start_container(self, config_container: ConfigContainer, container_name: str, fingerprint: str) -> bool:
+        self._docker_util.get_engine().remove_container(container_name, force=True)
+        process = subprocess.run(
+            self.build_start_command(config_container, fingerprint),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        if process.returncode != 0 and not self.is_running(container_name, fingerprint):
+            if not self._docker_util.quiet:
+                print(process.stderr.strip(), file=sys.stderr)
+            return False
+        return True
+
+    def release(self) -> None:
+        if self._lock:
+            self.touch(self._container_name)
+            self._lock.release()
+            self._lock = None
+
+    def get_last_used_path(self, container_name: str) -> str:
+        return os.path.join(self._state_dir, container_name + '.last-used')
+
+    def touch(self, container_name: str) -> None:
+        os.makedirs(self._state_dir, exist_ok=True)
+        with open(self.get_last_used_path(container_name), 'a'):
+            pass
+        os.utime(self.get_last_used_path(container_name))
+
+    def get_last_used(self, container_name: str, container: dict) -> float:
+        try:
+            return os.path.getmtime(self.get_last_used_path(container_name))
+        except OSError:
+            return container.get('Created', 0)
+
+    def reap(self, engine: DockerEngineClient) -> None:
+        for container in engine.list_containers({'label': [PERSISTENT_LABEL]}):
+            container_name = container['Names'][0].lstrip('/')
+            idle_timeout = int((container.get('Labels') or {}).get(IDLE_TIMEOUT_LABEL, DEFAULT_IDLE_TIMEOUT))
+            if time.time() - self.get_last_used(container_name, container) < idle_timeout:
+                continue
+            start_lock = self.get_start_lock(container_name)
+            lock = self.get_lock(container_name)
+            if not start_lock.acquire(blocking=False):
+                continue
+            try:
+                if lock.acquire(blocking=False):
+                    engine.remove_container(container['Id'], force=True)
+                    if os.path.exists(self.get_last_used_path(container_name)):
+                        os.remove(self.get_last_used_path(container_name))
+                    volume_names = (container.get('Labels') or {}).get(VOLUMES_LABEL, '')
+                    VolumeManager(self._docker_util).remove_unused(engine, list(filter(None, volume_names.split(','))))
+            finally:
+                lock.release()
+                start_lock.release()
@@ -0,0 +1,167 @@
+import errno
+import fcntl
+import os
+import pty
+import selectors
+import signal
+import subprocess
+import termios
+from typing import List, Optional
+
+BUFFER_SIZE = 64 * 1024
+# output still buffered in the pty is drained for at most this long once the child exited
+DRAIN_TIMEOUT = 1.0
+EXIT_CHECK_INTERVAL = 0.5
+
+
+def acquire_controlling_terminal() -> None:
+    # runs in the child: a new session with the pty as controlling terminal, so it receives SIGWINCH
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+def write_all(fd: int, data) -> None:
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class PtyRelay:
+    def __init__(self, input_fd: int = 0, output_fd: int = 1) -> None:
+        self._input_fd = input_fd
+        self._output_fd = output_fd
+        self._buffer = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._pending_input = bytearray()
+        self._input_closed = False
+
+    def copy_window_size(self, master_fd: int) -> None:
+        try:
+            window_size = fcntl.ioctl(self._input_fd, termios.TIOCGWINSZ, b'\0' * 8)
+            fcntl.ioctl(master_fd, termios.TIOCSWINSZ, window_size)
+        except OSError:
+            pass
+
+    def read_into_buffer(self, fd: int) -> int:
+        try:
+            return os.readv(fd, [self._buffer])
+        except BlockingIOError:
+            return -1
+        except OSError as e:
+            # linux reports EIO on the master once every slave fd is closed
+            if e.errno == errno.EIO:
+                return 0
+            raise
+
+    def run(self, argv: List[str]) -> int:
+        master_fd, slave_fd = pty.openpty()
+        self.copy_window_size(master_fd)
+        try:
+            process = subprocess.Popen(
+                argv,
+                preexec_fn=acquire_controlling_terminal,
+                stdin=slave_fd,
+                stdout=slave_fd,
+                stderr=slave_fd
+            )
+        finally:
+            # only the child may hold the slave, otherwise the master never reports its end
+            os.close(slave_fd)
+
+        wakeup_read_fd, wakeup_write_fd = os.pipe()
+        os.set_blocking(master_fd, False)
+        os.set_blocking(wakeup_write_fd, False)
+        previous_handler = self.install_resize_handler(wakeup_write_fd)
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(master_fd, selectors.EVENT_READ)
+            selector.register(self._input_fd, selectors.EVENT_READ)
+            selector.register(wakeup_read_fd, selectors.EVENT_READ)
+            self.relay(selector, process, master_fd, wakeup_read_fd)
+        finally:
+            if previous_handler is not None:
+                signal.signal(signal.SIGWINCH, previous_handler)
+            selector.close()
+            for fd in (master_fd, wakeup_read_fd, wakeup_write_fd):
+                os.close(fd)
+        return process.wait()
+
+    @staticmethod
+    def install_resize_handler(wakeup_write_fd: int) -> Optional[object]:
+        def on_resize(*_) -> None:
+            try:
+                os.write(wakeup_write_fd, b'\0')
+            except BlockingIOError:
+                pass
+
+        try:
+            return signal.signal(signal.SIGWINCH, on_resize)
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            return None
+
+    def relay(self, selector: selectors.BaseSelector, process: subprocess.Popen, master_fd: int,
+              wakeup_read_fd: int) -> None:
+        child_exited = False
+        while True:
+            events = selector.select(DRAIN_TIMEOUT if child_exited else EXIT_CHECK_INTERVAL)
+            if not events:
+                if child_exited:
+                    # the child is gone but something else still holds the slave open
+                    return
+                if process.poll() is not None:
+                    child_exited = True
+                    self.close_input(selector)
+                continue
+
+            for key, mask in events:
+                if key.fd == master_fd and not self.handle_master(selector, mask, master_fd):
+                    return
+                if key.fd == self._input_fd and not self._input_closed:
+                    self.handle_input(selector, master_fd)
+                if key.fd == wakeup_read_fd:
+                    os.read(wakeup_read_fd, BUFFER_SIZE)
+                    self.copy_window_size(master_fd)
+
+    def handle_master(self, selector: selectors.BaseSelector, mask: int, master_fd: int) -> bool:
+        # False once the child side of the pty is closed
+        if mask & selectors.EVENT_READ:
+            size = self.read_into_buffer(master_fd)
+            if size == 0:
+                return False
+            if size > 0:
+                write_all(self._output_fd, self._view[:size])
+        if mask & selectors.EVENT_WRITE:
+            self.flush_input(selector, master_fd)
+        return True
+
+    def handle_input(self, selector: selectors.BaseSelector, master_fd: int) -> None:
+        size = self.read_into_buffer(self._input_fd)
+        if size == 0:
+            self.close_input(selector)
+        elif size > 0:
+            self._pending_input += self._view[:size]
+            self.flush_input(selector, master_fd)
+
+    def close_input(self, selector: selectors.BaseSelector) -> None:
+        self._input_closed = True
+        if self._input_fd in selector.get_map():
+            selector.unregister(self._input_fd)
+
+    def flush_input(self, selector: selectors.BaseSelector, master_fd: int) -> None:
+        # the child may not read its input right away, queue it instead of blocking the output direction
+        try:
+            written = os.write(master_fd, self._pending_input)
+            del self._pending_input[:written]
+        except BlockingIOError:
+            pass
+        events = selectors.EVENT_READ
+        if self._pending_input:
+            events |= selectors.EVENT_WRITE
+        selector.modify(master_fd, events)
+        if self._input_closed:
+            return
+        if len(self._pending_input) >= BUFFER_SIZE and self._input_fd in selector.get_map():
+            selector.unregister(self._input_fd)
+        elif len(self._pending_input) < BUFFER_SIZE and self._input_fd not in selector.get_map():
+            selector.register(self._input_fd, selectors.EVENT_READ)
@@ -0,0 +1,266 @@
+import array
+import json
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+from lib.config import INI_CONFIG_DIR
+
+RUN_SOCKET_PATH = os.path.join(INI_CONFIG_DIR, 'docker-alias.sock')
+MESSAGE_HEADER = struct.Struct('!I')
+PEER_CREDENTIALS = struct.Struct('3i')
+FORWARDED_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT, signal.SIGWINCH)
+STANDARD_FDS = (0, 1, 2)
+# requests are read inline by the accepting thread, a stalled client must not hold up everyone else
+REQUEST_TIMEOUT = 5
+
+
+def get_run_socket_path() -> str:
+    return os.environ.get('DOCKER_ALIAS_SOCKET', RUN_SOCKET_PATH)
+
+
+def read_line(connection: socket.socket, buffer: bytearray) -> Optional[dict]:
+    while b'\n' not in buffer:
+        chunk = connection.recv(4096)
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    line, _, rest = bytes(buffer).partition(b'\n')
+    buffer[:] = rest
+    return json.loads(line)
+
+
+class RunClient:
+    def __init__(self, socket_path: str = None) -> None:
+        self._socket_path = socket_path or get_run_socket_path()
+
+    def run(self, argv: List[str]) -> Optional[int]:
+        # None means the server is not available and the caller should run the command itself
+        if os.environ.get('DOCKER_ALIAS_NO_SERVER') or not os.path.exists(self._socket_path):
+            return None
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self._socket_path)
+            self.send_request(connection, argv)
+            buffer = bytearray()
+            started = read_line(connection, buffer)
+        except OSError:
+            connection.close()
+            return None
+        if not started:
+            connection.close()
+            return None
+
+        pid = started['pid']
+        for signal_number in FORWARDED_SIGNALS:
+            signal.signal(signal_number, lambda number, frame: self.forward_signal(pid, number))
+        try:
+            finished = read_line(connection, buffer)
+        finally:
+            connection.close()
+        if not finished:
+            print('docker-alias-daemon closed the connection unexpectedly', file=sys.stderr)
+            return 1
+        return finished['exit_code']
+
+    @staticmethod
+    def forward_signal(pid: int, signal_number: int) -> None:
+        try:
+            os.kill(pid, signal_number)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def send_request(connection: socket.socket, argv: List[str]) -> None:
+        message = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode('utf-8')
+        message = MESSAGE_HEADER.pack(len(message)) + message
+        sent = connection.sendmsg(
+            [message],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', STANDARD_FDS))]
+        )
+        connection.sendall(message[sent:])
+
+
+# serves from a single thread on purpose: every request forks a worker, and a worker forked while another thread
+# holds a lock, like the state store cache or a stdio buffer, would wait for it forever
+class RunServer:
+    def __init__(self, handler: Callable[[List[str]], int], socket_path: str = None) -> None:
+        self._handler = handler
+        self._socket_path = socket_path or get_run_socket_path()
+        # connections waiting for the exit code of their worker, by worker pid
+        self._connections: Dict[int, socket.socket] = {}
+        self._selector = None
+        self._server = None
+        self._pipe_fds: List[int] = []
+
+    def bind(self) -> socket.socket:
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self._socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(64)
+        return server
+
+    def serve_forever(self, parent_fd: int = None) -> None:
+        # returns once parent_fd, the read end of a pipe the parent holds open, reports end of file
+        self._server = self.bind()
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda number, frame: None)
+        self._pipe_fds = [wakeup_read, wakeup_write] + ([parent_fd] if parent_fd is not None else [])
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ, self.accept)
+        self._selector.register(wakeup_read, selectors.EVENT_READ, self.reap_children)
+        if parent_fd is not None:
+            self._selector.register(parent_fd, selectors.EVENT_READ)
+        try:
+            while True:
+                for key, _ in self._selector.select():
+                    if key.data is None:
+                        return
+                    key.data(key.fileobj)
+        finally:
+            # callers fall back to running the command themselves once the socket is gone
+            if os.path.exists(self._socket_path):
+                os.remove(self._socket_path)
+
+    def accept(self, server: socket.socket) -> None:
+        connection, _ = server.accept()
+        try:
+            self.handle(connection)
+        except Exception:
+            traceback.print_exc()
+            connection.close()
+
+    def handle(self, connection: socket.socket) -> None:
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+        _, uid, _ = PEER_CREDENTIALS.unpack(credentials)
+        if uid != os.getuid():
+            connection.close()
+            return
+
+        connection.settimeout(REQUEST_TIMEOUT)
+        request, fds = self.receive_request(connection)
+        connection.settimeout(None)
+        if len(fds) != len(STANDARD_FDS):
+            for fd in fds:
+                os.close(fd)
+            connection.close()
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.close_server_fds()
+            connection.close()
+            self.run_child(request, fds)
+
+        for fd in fds:
+            os.close(fd)
+        self._connections[pid] = connection
+        connection.sendall(json.dumps({'pid': pid}).encode('utf-8') + b'\n')
+
+    def close_server_fds(self) -> None:
+        # the worker must not keep the socket or the connections of other runs open once the server is gone
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self._selector.close()
+        self._server.close()
+        for fd in self._pipe_fds:
+            os.close(fd)
+        for other_connection in self._connections.values():
+            other_connection.close()
+        self._connections.clear()
+
+    def reap_children(self, wakeup_read: int) -> None:
+        try:
+            while os.read(wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        for pid in list(self._connections):
+            finished_pid, status = os.waitpid(pid, os.WNOHANG)
+            if finished_pid:
+                self.report_exit_code(self._connections.pop(pid), status)
+
+    @staticmethod
+    def receive_request(connection: socket.socket) -> Tuple[dict, List[int]]:
+        fds = array.array('i')
+        data, ancillary_data, _, _ = connection.recvmsg(65536, socket.CMSG_SPACE(len(STANDARD_FDS) * fds.itemsize))
+        for level, message_type, cmsg_data in ancillary_data:
+            if level == socket.SOL_SOCKET and message_type == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
+        try:
+            if not data:
+                raise ConnectionError('incomplete run request')
+            buffer = bytearray(data)
+            RunServer.receive_until(connection, buffer, MESSAGE_HEADER.size)
+            length, = MESSAGE_HEADER.unpack_from(buffer)
+            RunServer.receive_until(connection, buffer, MESSAGE_HEADER.size + length)
+            return json.loads(bytes(buffer[MESSAGE_HEADER.size:MESSAGE_HEADER.size + length])), list(fds)
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+
+    @staticmethod
+    def receive_until(connection: socket.socket, buffer: bytearray, size: int) -> None:
+        # an empty read means the client closed the connection
+        while len(buffer) < size:
+            chunk = connection.recv(65536)
+            if not chunk:
+                raise ConnectionError('incomplete run request')
+            buffer.extend(chunk)
+
+    def run_child(self, request: dict, fds: List[int]) -> None:
+        exit_code = 1
+        try:
+            os.setsid()
+            for target_fd, fd in zip(STANDARD_FDS, fds):
+                os.dup2(fd, target_fd)
+                os.close(fd)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.chdir(request['cwd'])
+            os.environ.clear()
+            os.environ.update(request['env'])
+            exit_code = self._handler(request['argv'])
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+            exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except KeyboardInterrupt:
+            exit_code = 130
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code or 0)
+
+    @staticmethod
+    def report_exit_code(connection: socket.socket, status: int) -> None:
+        if os.WIFSIGNALED(status):
+            exit_code = 128 + os.WTERMSIG(status)
+        else:
+            exit_code = os.WEXITSTATUS(status)
+        try:
+            connection.sendall(json.dumps({'exit_code': exit_code}).encode('utf-8') + b'\n')
+        except OSError:
+            pass
+        finally:
+            connection.close()
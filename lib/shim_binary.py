@@ -1,12 +1,91 @@
+import hashlib
+import json
 import os
-from typing import Iterable, List, Optional, Set
+import shlex
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-from lib.config import SHIM_BINARY_DIR, INIConfig, YAMLConfigUtil
+from lib.config import SHIM_BINARY_DIR, INI_CONFIG_DIR, PLAN_DIR, VERSION, INIConfig, YAMLConfigUtil
+from lib.file_util import FileLock, atomic_write
+
+SHIM_MANIFEST_PATH = os.path.join(INI_CONFIG_DIR, 'shim-manifest.json')
+SHIM_MANIFEST_FORMAT = 1
+# below this many changed files forking parser processes costs more than it saves
+PARALLEL_PARSE_THRESHOLD = 8
+
+# Executes the plan docker-alias recorded for this command and directory directly with docker, as long as
+# the yaml files, the interpolated environment variables and the docker-alias version are unchanged.
+SHIM_BINARY_TEMPLATE = '''#!/usr/bin/env bash
+plan_file={plan_dir}/"${{0##*/}}${{PWD%/}}.plan"
+if [[ -z $DOCKER_ALIAS_NO_PLAN && -z $DOCKER_ALIAS_TRACE && -r $plan_file ]] \\
+        && (( BASH_VERSINFO[0] * 100 + BASH_VERSINFO[1] >= 404 )) \\
+        && source "$plan_file" 2>/dev/null && [[ $plan_version == {version} ]]; then
+    plan_valid=1
+    printf -v plan_now '%(%s)T' -1
+    if (( plan_expires && plan_now >= plan_expires )); then plan_valid=; fi
+    for plan_path in "${{plan_files[@]}}"; do
+        if [[ ! -f $plan_path || $plan_path -nt $plan_file ]]; then plan_valid=; fi
+    done
+    for plan_path in "${{plan_absent[@]}}"; do
+        if [[ -e $plan_path ]]; then plan_valid=; fi
+    done
+    for (( i = 0; i < ${{#plan_env[@]}}; i += 3 )); do
+        plan_var=${{plan_env[i]}}
+        if [[ ${{plan_env[i + 1]}} == 1 ]]; then
+            if [[ ${{!plan_var@a}} != *x* || ${{!plan_var}} != "${{plan_env[i + 2]}}" ]]; then plan_valid=; fi
+        elif [[ ${{!plan_var@a}} == *x* ]]; then
+            plan_valid=
+        fi
+    done
+    if [[ $plan_valid ]]; then
+        plan_tty=(-i)
+        if [[ -t 0 && -t 1 ]]; then plan_tty=(-it); fi
+        # 64 random bits like docker-alias run, pids repeat across pid namespaces sharing one engine
+        if [[ $SRANDOM ]]; then
+            printf -v plan_suffix '%08x%08x' "$SRANDOM" "$SRANDOM"
+        else
+            read -r plan_suffix < <(od -An -tx8 -N8 /dev/urandom)
+        fi
+        exec "${{plan_docker[@]}}" "--name=${{plan_name}}_$$_$plan_suffix" "${{plan_tty[@]}}" "${{plan_args[@]}}" "$@"
+    fi
+fi
+exec docker-alias run "$0" "$@"
+'''
+
+
+# remembers the fingerprint of every registered yaml with the commands it defines and the content of the
+# written shims, so a sync only parses changed files and only writes shims that are missing or outdated
+class ShimManifest:
+    def __init__(self, path: str = SHIM_MANIFEST_PATH) -> None:
+        self._path = path
+
+    def get_lock(self) -> FileLock:
+        return FileLock(self._path + '.lock')
+
+    def load(self) -> dict:
+        try:
+            with open(self._path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = {}
+        if not isinstance(manifest, dict) or manifest.get('schema') != [SHIM_MANIFEST_FORMAT, VERSION]:
+            manifest = {}
+        manifest['schema'] = [SHIM_MANIFEST_FORMAT, VERSION]
+        manifest.setdefault('files', {})
+        manifest.setdefault('content_hash', None)
+        return manifest
+
+    def store(self, manifest: dict) -> None:
+        try:
+            atomic_write(self._path, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+        except OSError:
+            # without a manifest the next sync parses everything again, which is still correct
+            pass
 
 
 class ShimBinaryManager:
-    def __init__(self, root_path: str = SHIM_BINARY_DIR) -> None:
+    def __init__(self, root_path: str = SHIM_BINARY_DIR, manifest: Optional[ShimManifest] = None) -> None:
         self._root_path = root_path
+        self._manifest = manifest or ShimManifest()
 
     def get_root_path(self) -> str:
         return self._root_path
@@ -22,18 +101,20 @@ class ShimBinaryManager:
     def _normalize_name(self, name: str) -> str:
         return name.replace('/', '')
 
-    def create(self, name: str) -> None:
+    def create(self, name: str, content: Optional[str] = None) -> None:
         normalized_name = self._normalize_name(name)
         if not normalized_name:
             return
-        self.ensure_root_exists()
-        file_path = os.path.join(self._root_path, normalized_name)
-        if os.path.isfile(file_path):
-            return
-        with open(file_path, 'w') as file:
-            file.write('#!/usr/bin/env bash\n')
-            file.write('docker-alias run $0 $@\n')
-        os.chmod(file_path, 0o775)
+        # a shell may run the shim at any moment, it must never see a partially written or non executable file
+        atomic_write(
+            os.path.join(self._root_path, normalized_name),
+            (content or self.get_content()).encode('utf-8'),
+            mode=0o775
+        )
+
+    @staticmethod
+    def get_content() -> str:
+        return SHIM_BINARY_TEMPLATE.format(plan_dir=shlex.quote(PLAN_DIR), version=shlex.quote(VERSION))
 
     def remove(self, name: str) -> None:
         normalized_name = self._normalize_name(name)
@@ -53,36 +134,111 @@ class ShimBinaryManager:
             for name in defined_shim_binaries
             if self._normalize_name(name)
         }
-        existing = set(self.list_binaries())
-        for shim_binary in existing - normalized_defined:
-            self.remove(shim_binary)
-        for shim_binary in normalized_defined:
-            self.create(shim_binary)
+        content = self.get_content()
+        content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        with self._manifest.get_lock():
+            manifest = self._manifest.load()
+            existing = set(self.list_binaries())
+            removed = existing - normalized_defined
+            created = normalized_defined - existing
+            if manifest['content_hash'] != content_hash:
+                # written by another version or for another plan directory
+                created = normalized_defined
+
+            for shim_binary in removed:
+                self.remove(shim_binary)
+            if created:
+                self.ensure_root_exists()
+            for shim_binary in created:
+                self.create(shim_binary, content)
+            if manifest['content_hash'] != content_hash:
+                manifest['content_hash'] = content_hash
+                self._manifest.store(manifest)
+
 
+def get_yaml_fingerprint(yaml_path: str) -> Optional[List[int]]:
+    try:
+        stat = os.stat(yaml_path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
 
-def collect_defined_shim_binaries(ini_config: Optional[INIConfig] = None) -> List[str]:
+
+def parse_shim_binaries(yaml_path: str) -> Tuple[str, dict]:
+    # the fingerprint is taken before reading, a change while parsing is then picked up by the next sync
+    entry = {'fingerprint': get_yaml_fingerprint(yaml_path), 'variables': {}, 'commands': [], 'valid': True}
+    yaml_config = YAMLConfigUtil().get_config(yaml_path)
+    if not yaml_config:
+        entry['valid'] = False
+        return yaml_path, entry
+    entry['variables'] = yaml_config.variables
+    containers = yaml_config.config.get('containers') if yaml_config.config else None
+    if not containers:
+        return yaml_path, entry
+    for container_key, container in containers.items():
+        commands = container.get('commands') if isinstance(container, dict) else None
+        if commands:
+            for command in commands:
+                if isinstance(command, dict):
+                    entry['commands'].append(list(command.keys())[0])
+                else:
+                    entry['commands'].append(command)
+        else:
+            entry['commands'].append(container_key)
+    return yaml_path, entry
+
+
+def parse_all_shim_binaries(yaml_paths: List[str], parallel: bool = True) -> Dict[str, dict]:
+    if not parallel or len(yaml_paths) < PARALLEL_PARSE_THRESHOLD or (os.cpu_count() or 1) < 2:
+        return dict(parse_shim_binaries(yaml_path) for yaml_path in yaml_paths)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # yaml parsing holds the gil, only processes parse in parallel
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context('fork')) as executor:
+        return dict(executor.map(parse_shim_binaries, yaml_paths, chunksize=4))
+
+
+def is_unchanged(entry: Optional[dict], fingerprint: List[int]) -> bool:
+    if not entry or entry['fingerprint'] != fingerprint:
+        return False
+    return all(os.environ.get(name) == value for name, value in entry['variables'].items())
+
+
+def collect_defined_shim_binaries(
+        ini_config: Optional[INIConfig] = None,
+        shim_manifest: Optional[ShimManifest] = None,
+        parallel: bool = True
+) -> List[str]:
+    # parallel parsing forks, which is only safe while the calling process runs no other threads
     ini_config = ini_config or INIConfig()
-    yaml_paths = ini_config.get_yaml_paths()
-    yaml_config_util = YAMLConfigUtil()
-    defined_shim_binaries: List[str] = []
-    for yml_path in yaml_paths:
-        if not os.path.isfile(yml_path):
-            continue
-        yaml_config = yaml_config_util.get_config(yml_path)
-        if not yaml_config:
-            print('Invalid Config: ' + yml_path)
-            continue
-        containers = yaml_config.config.get('containers') if yaml_config.config else None
-        if not containers:
-            continue
-        for container_key, container in containers.items():
-            commands = container.get('commands') if isinstance(container, dict) else None
-            if commands:
-                for command in commands:
-                    if isinstance(command, dict):
-                        defined_shim_binaries.append(list(command.keys())[0])
-                    else:
-                        defined_shim_binaries.append(command)
+    shim_manifest = shim_manifest or ShimManifest()
+    yaml_paths = list(dict.fromkeys(ini_config.get_yaml_paths()))
+    with shim_manifest.get_lock():
+        manifest = shim_manifest.load()
+        files: Dict[str, dict] = {}
+        changed_paths: List[str] = []
+        for yaml_path in yaml_paths:
+            fingerprint = get_yaml_fingerprint(yaml_path)
+            if fingerprint is None or not os.path.isfile(yaml_path):
+                continue
+            if is_unchanged(manifest['files'].get(yaml_path), fingerprint):
+                files[yaml_path] = manifest['files'][yaml_path]
             else:
-                defined_shim_binaries.append(container_key)
+                changed_paths.append(yaml_path)
+
+        for yaml_path, entry in parse_all_shim_binaries(changed_paths, parallel).items():
+            if not entry['valid']:
+                print('Invalid Config: ' + yaml_path)
+            files[yaml_path] = entry
+
+        if files != manifest['files']:
+            manifest['files'] = files
+            shim_manifest.store(manifest)
+
+    defined_shim_binaries: List[str] = []
+    for yaml_path in yaml_paths:
+        if yaml_path in files:
+            defined_shim_binaries.extend(files[yaml_path]['commands'])
     return defined_shim_binaries
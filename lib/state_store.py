@@ -0,0 +1,111 @@
+import copy
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+
+from lib.file_util import FileLock, atomic_write
+
+REGISTRATIONS = 'registrations'
+BUILD_HASHES = 'build_hashes'
+SETTINGS = 'settings'
+# build hashes of images that are no longer built would otherwise pile up forever
+MAX_BUILD_HASHES = 256
+
+# parsed namespaces by path, reused for as long as the file keeps its mtime, size and inode
+_cache: Dict[str, Tuple[tuple, dict]] = {}
+_cache_lock = threading.Lock()
+
+
+def get_file_key(path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+# every namespace is a json object in its own file, so registering a config, storing a build hash and
+# toggling a setting neither wait for nor overwrite each other. Writes replace the file atomically while
+# holding the lock of the namespace, reads never wait.
+class StateStore:
+    def __init__(self, state_dir: str) -> None:
+        self._state_dir = state_dir
+
+    def get_state_dir(self) -> str:
+        os.makedirs(self._state_dir, exist_ok=True)
+        return self._state_dir
+
+    def get_path(self, namespace: str) -> str:
+        return os.path.join(self._state_dir, namespace + '.json')
+
+    def get_lock(self, namespace: str) -> FileLock:
+        return FileLock(self.get_path(namespace) + '.lock')
+
+    def exists(self, namespace: str) -> bool:
+        return os.path.exists(self.get_path(namespace))
+
+    def read(self, namespace: str) -> dict:
+        # the returned object is shared with later reads and must not be modified
+        path = self.get_path(namespace)
+        # taken before reading, a concurrent replacement is then read again next time
+        file_key = get_file_key(path)
+        if file_key is None:
+            return {}
+        with _cache_lock:
+            cached = _cache.get(path)
+        if cached and cached[0] == file_key:
+            return cached[1]
+
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # only written atomically, so this was edited by hand
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        with _cache_lock:
+            _cache[path] = (file_key, data)
+        return data
+
+    def write(self, namespace: str, data: dict) -> None:
+        path = self.get_path(namespace)
+        atomic_write(path, json.dumps(data, indent=2).encode('utf-8'))
+        file_key = get_file_key(path)
+        with _cache_lock:
+            _cache[path] = (file_key, data)
+
+    @contextmanager
+    def transaction(self, namespace: str) -> Iterator[dict]:
+        # not re-entrant, flock also blocks a second lock of the same file within one process
+        self.get_state_dir()
+        with self.get_lock(namespace):
+            current = self.read(namespace)
+            data = copy.deepcopy(current)
+            yield data
+            if data != current or not self.exists(namespace):
+                self.write(namespace, data)
+
+    def get(self, namespace: str, key: str, default=None):
+        return self.read(namespace).get(key, default)
+
+    def set(self, namespace: str, key: str, value) -> None:
+        with self.transaction(namespace) as data:
+            data[key] = value
+
+    def get_build_hash(self, image_name: str) -> Optional[str]:
+        entry = self.get(BUILD_HASHES, image_name)
+        return entry.get('hash') if isinstance(entry, dict) else None
+
+    def set_build_hash(self, image_name: str, build_hash: str) -> None:
+        with self.transaction(BUILD_HASHES) as data:
+            data[image_name] = {'hash': build_hash, 'updated_at': time.time()}
+            if len(data) > MAX_BUILD_HASHES:
+                by_age = sorted(data, key=lambda name: data[name].get('updated_at', 0))
+                for name in by_age[:len(data) - MAX_BUILD_HASHES]:
+                    del data[name]
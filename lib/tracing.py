@@ -0,0 +1,160 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+TRACE_ENVIRONMENT_VARIABLE = 'DOCKER_ALIAS_TRACE'
+SUMMARY_MODE = 'summary'
+STDERR_MODES = ('1', 'stderr')
+DISABLED_MODES = ('', '0')
+
+
+class NullSpan:
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+# shared by every span while tracing is disabled, so an untraced invocation only pays a function call
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    def __init__(self, tracer: 'Tracer', name: str, attributes: dict) -> None:
+        self._tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = None
+        self.parent_id = None
+        self.start = 0.0
+        self._start_counter = 0.0
+
+    def __enter__(self) -> 'Span':
+        self._tracer.enter(self)
+        self.start = time.time()
+        self._start_counter = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback) -> None:
+        duration = time.perf_counter() - self._start_counter
+        if isinstance(exception, SystemExit):
+            self.attributes['exit_code'] = exception.code
+        elif exception_type is not None:
+            self.attributes['error'] = exception_type.__name__
+        self._tracer.exit(self, duration)
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    def __init__(self, mode: str) -> None:
+        self._mode = mode
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_id = 1
+        self._file = None
+        # name -> [count, total seconds, max seconds]
+        self._summary: Dict[str, List[float]] = {}
+
+    def get_stack(self) -> List[Span]:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def enter(self, span: Span) -> None:
+        stack = self.get_stack()
+        with self._lock:
+            span.span_id = self._next_id
+            self._next_id += 1
+        span.parent_id = stack[-1].span_id if stack else None
+        stack.append(span)
+
+    def exit(self, span: Span, duration: float) -> None:
+        stack = self.get_stack()
+        if span in stack:
+            stack.remove(span)
+        if self._mode == SUMMARY_MODE:
+            with self._lock:
+                entry = self._summary.setdefault(span.name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += duration
+                entry[2] = max(entry[2], duration)
+            return
+        line = json.dumps({
+            'name': span.name,
+            'id': span.span_id,
+            'parent': span.parent_id,
+            'pid': os.getpid(),
+            'start': round(span.start, 6),
+            'duration_ms': round(duration * 1000, 3),
+            'attributes': span.attributes,
+        }, default=str) + '\n'
+        with self._lock:
+            self.write(line)
+
+    def write(self, line: str) -> None:
+        if self._mode in STDERR_MODES:
+            sys.stderr.write(line)
+            sys.stderr.flush()
+            return
+        if self._file is None:
+            # appending single lines keeps the output of concurrent invocations apart
+            self._file = open(self._mode, 'a', buffering=1)
+        self._file.write(line)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._mode == SUMMARY_MODE and self._summary:
+                self.print_summary()
+                self._summary = {}
+
+    def print_summary(self) -> None:
+        name_width = max(len(name) for name in self._summary)
+        lines = ['{name}  {count:>5}  {total:>10}  {max:>10}'.format(
+            name='span'.ljust(name_width), count='calls', total='total ms', max='max ms'
+        )]
+        for name, (count, total, maximum) in sorted(self._summary.items(), key=lambda item: -item[1][1]):
+            lines.append('{name}  {count:>5}  {total:>10.2f}  {max:>10.2f}'.format(
+                name=name.ljust(name_width), count=count, total=total * 1000, max=maximum * 1000
+            ))
+        sys.stderr.write('\n'.join(lines) + '\n')
+        sys.stderr.flush()
+
+
+_tracer: Optional[Tracer] = None
+
+
+def span(name: str, **attributes):
+    if _tracer is None:
+        return NULL_SPAN
+    return Span(_tracer, name, attributes)
+
+
+def configure_tracing(mode: Optional[str] = None) -> None:
+    # stderr (or 1) writes one json line per span to stderr, summary prints a table at exit, anything else is a file
+    global _tracer
+    if mode is None:
+        mode = os.environ.get(TRACE_ENVIRONMENT_VARIABLE, '')
+    finish_tracing()
+    if mode not in DISABLED_MODES:
+        _tracer = Tracer(mode)
+        atexit.register(finish_tracing)
+
+
+def finish_tracing() -> None:
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
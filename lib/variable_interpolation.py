@@ -0,0 +1,43 @@
+import re
+from typing import Dict, Mapping, Optional
+
+# $$, $NAME, ${NAME}, ${NAME:-default} and ${NAME-default}
+TOKEN_PATTERN = re.compile(
+    r'\$(?:'
+    r'(?P<escaped>\$)'
+    r'|(?P<name>[A-Za-z_][A-Za-z0-9_]*)'
+    r'|\{(?P<braced>[A-Za-z_][A-Za-z0-9_]*)(?:(?P<operator>:?-)(?P<default>[^}]*))?\}'
+    r')'
+)
+
+
+class VariableInterpolator:
+    def __init__(self, environment: Mapping[str, str], fallbacks: Optional[Dict[str, str]] = None) -> None:
+        self._environment = environment
+        self._fallbacks = fallbacks or {}
+        # environment values of every looked up name, None if it was not set
+        self.dependencies: Dict[str, Optional[str]] = {}
+
+    def lookup(self, name: str) -> Optional[str]:
+        if name not in self.dependencies:
+            self.dependencies[name] = self._environment.get(name)
+        value = self.dependencies[name]
+        if value is None:
+            return self._fallbacks.get(name)
+        return value
+
+    def replace(self, match) -> str:
+        if match.group('escaped'):
+            return '$'
+        name = match.group('name') or match.group('braced')
+        value = self.lookup(name)
+        operator = match.group('operator')
+        if operator and (value is None or (operator == ':-' and value == '')):
+            return self.interpolate(match.group('default'))
+        if value is None:
+            # unknown variables stay as they are
+            return match.group(0)
+        return value
+
+    def interpolate(self, text: str) -> str:
+        return TOKEN_PATTERN.sub(self.replace, text)
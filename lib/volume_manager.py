@@ -0,0 +1,164 @@
+import json
+import os
+import sys
+import time
+from typing import List, Tuple
+
+from lib.config import INI_CONFIG_DIR
+from lib.config_container import ConfigContainer
+from lib.docker_engine import DockerEngineClient, DockerEngineError
+from lib.file_util import FileLock, atomic_write
+from lib.volume import VolumeWithDriver
+
+VOLUME_STATE_DIR = os.path.join(INI_CONFIG_DIR, 'volumes')
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# every run registers its pid with the driver volumes it mounts, a volume is removed once no registered
+# process is left unless one of them asked to keep it, pids of crashed runs are dropped the next time the
+# state is read
+class VolumeManager:
+    def __init__(self, docker_util, state_dir: str = VOLUME_STATE_DIR) -> None:
+        self._docker_util = docker_util
+        self._state_dir = state_dir
+
+    def get_volumes(self, config_container: ConfigContainer) -> List[Tuple[str, VolumeWithDriver]]:
+        volumes = {}
+        for volume in config_container.volumes or []:
+            if isinstance(volume, VolumeWithDriver):
+                volume_name = self._docker_util.volume_name_pattern.format(
+                    fs_location_hash=config_container.fs_location_hash,
+                    volume_name=volume.name
+                )
+                volumes.setdefault(volume_name, volume)
+        return list(volumes.items())
+
+    def get_lock(self, volume_name: str) -> FileLock:
+        return FileLock(os.path.join(self._state_dir, volume_name + '.lock'))
+
+    def get_state_path(self, volume_name: str) -> str:
+        return os.path.join(self._state_dir, volume_name + '.json')
+
+    def load_state(self, volume_name: str) -> dict:
+        try:
+            with open(self.get_state_path(volume_name)) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = {}
+        # written by an older version as a plain list of pids
+        holders = state.pop('holders', None) or [{'pid': pid, 'keep': False} for pid in state.pop('users', [])]
+        state['holders'] = [holder for holder in holders if process_exists(holder['pid'])]
+        if any(holder['keep'] for holder in holders if holder not in state['holders']):
+            # a run that asked for keep_volumes died without releasing, its volume must survive the reaper
+            state['keep'] = True
+        return state
+
+    def store_state(self, volume_name: str, state: dict) -> None:
+        atomic_write(self.get_state_path(volume_name), json.dumps(state).encode('utf-8'))
+
+    def remove_state(self, volume_name: str, lock: FileLock) -> None:
+        if os.path.exists(self.get_state_path(volume_name)):
+            os.remove(self.get_state_path(volume_name))
+        lock.remove()
+
+    def for_each_volume(self, config_container: ConfigContainer, function) -> None:
+        volumes = self.get_volumes(config_container)
+        if len(volumes) <= 1:
+            for volume in volumes:
+                function(*volume)
+            return
+        from concurrent.futures import ThreadPoolExecutor
+
+        # each call only holds the lock of its own volume, so they cannot deadlock
+        with ThreadPoolExecutor(max_workers=len(volumes)) as executor:
+            for future in [executor.submit(function, *volume) for volume in volumes]:
+                future.result()
+
+    def acquire(self, config_container: ConfigContainer) -> None:
+        engine = self._docker_util.get_engine()
+        # a persistent container keeps the volumes mounted beyond this run
+        keep = config_container.keep_volumes or config_container.persistent
+
+        def acquire_volume(volume_name: str, volume: VolumeWithDriver) -> None:
+            with self.get_lock(volume_name):
+                state = self.load_state(volume_name)
+                state['holders'].append({'pid': os.getpid(), 'keep': keep})
+                state['grace_period'] = config_container.volume_grace_period
+                state.pop('released_at', None)
+                self.store_state(volume_name, state)
+                if engine.inspect_volume(volume_name) is None:
+                    engine.create_volume(volume_name, driver=volume.driver, driver_opts=volume.driver_opts)
+
+        self.for_each_volume(config_container, acquire_volume)
+
+    def release(self, config_container: ConfigContainer, remove: bool = True) -> None:
+        engine = self._docker_util.get_engine()
+
+        def release_volume(volume_name: str, _: VolumeWithDriver) -> None:
+            with self.get_lock(volume_name) as lock:
+                state = self.load_state(volume_name)
+                state['holders'] = [holder for holder in state['holders'] if holder['pid'] != os.getpid()]
+                if state['holders']:
+                    self.store_state(volume_name, state)
+                elif not remove or state.get('keep'):
+                    self.remove_state(volume_name, lock)
+                elif config_container.volume_grace_period > 0:
+                    # the daemon removes it once the grace period passed without a new holder
+                    state['released_at'] = time.time()
+                    self.store_state(volume_name, state)
+                else:
+                    self.remove_volume(engine, volume_name, lock)
+
+        self.for_each_volume(config_container, release_volume)
+
+    def remove_volume(self, engine: DockerEngineClient, volume_name: str, lock: FileLock) -> None:
+        try:
+            engine.remove_volume(volume_name, force=True)
+        except DockerEngineError as e:
+            # still mounted by a container docker-alias does not track, e.g. a persistent one
+            if not self._docker_util.quiet:
+                print(e, file=sys.stderr)
+        self.remove_state(volume_name, lock)
+
+    def remove_unused(self, engine: DockerEngineClient, volume_names: List[str]) -> None:
+        # the volumes of a removed persistent container, unless a run still holds them or asked to keep them
+        for volume_name in volume_names:
+            with self.get_lock(volume_name) as lock:
+                state = self.load_state(volume_name)
+                if not state['holders'] and not state.get('keep'):
+                    self.remove_volume(engine, volume_name, lock)
+
+    def reap(self, engine: DockerEngineClient) -> None:
+        if not os.path.isdir(self._state_dir):
+            return
+        for file_name in os.listdir(self._state_dir):
+            if not file_name.endswith('.json'):
+                continue
+            volume_name = file_name[:-len('.json')]
+            lock = self.get_lock(volume_name)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if not os.path.exists(self.get_state_path(volume_name)):
+                    continue
+                state = self.load_state(volume_name)
+                if state['holders']:
+                    continue
+                if state.get('keep'):
+                    self.remove_state(volume_name, lock)
+                    continue
+                # without released_at the last holder exited without releasing the volume
+                released_at = state.get('released_at', os.path.getmtime(self.get_state_path(volume_name)))
+                if time.time() - released_at >= state.get('grace_period', 0):
+                    self.remove_volume(engine, volume_name, lock)
+            finally:
+                lock.release()